@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Compares the build context dazel sends docker against the whole directory.
+
+Docker's own behavior is to tar the entire context directory (minus the
+.dockerignore patterns), while dazel only streams the files that the
+Dockerfile's COPY and ADD instructions use. This reports the bytes and the
+wall time of both, along with the time to compute the image content digest
+with a cold and with a warm digest cache.
+
+Usage:
+    python benchmarks/build_context.py [--directory DIR] [--dockerfile FILE]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import dazel  # noqa: E402
+
+
+class CountingWriter(object):
+    """A file object that discards its data and counts the bytes written."""
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        return len(data)
+
+
+def full_context(directory):
+    """Tars the whole directory like 'docker build DIRECTORY' does."""
+    ignore = dazel.DockerIgnore.from_directory(directory)
+    writer = CountingWriter()
+    files = 0
+    tar = tarfile.open(fileobj=writer, mode="w|")
+    for (root, directories, names) in os.walk(directory):
+        relative_root = os.path.relpath(root, directory)
+        if relative_root == ".":
+            relative_root = ""
+        for name in names:
+            path = os.path.join(relative_root, name)
+            if not ignore.is_ignored(path):
+                tar.add(os.path.join(root, name), arcname=path,
+                        recursive=False)
+                files += 1
+    tar.close()
+    return files, writer.bytes
+
+
+def minimal_context(directory, dockerfile):
+    """Tars only the files the Dockerfile uses, like dazel does."""
+    build_context = dazel.BuildContext(directory, dockerfile)
+    writer = CountingWriter()
+    build_context.write_tar(writer)
+    return len(build_context.files()), writer.bytes
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--directory", default=os.getcwd(),
+                        help="The build context directory.")
+    parser.add_argument("--dockerfile", default=None,
+                        help="The Dockerfile (default: Dockerfile.dazel in the "
+                        "directory).")
+    args = parser.parse_args()
+    dockerfile = args.dockerfile or os.path.join(args.directory,
+                                                 dazel.DEFAULT_LOCAL_DOCKERFILE)
+
+    (full_files, full_bytes), full_seconds = timed(full_context,
+                                                   args.directory)
+    (minimal_files, minimal_bytes), minimal_seconds = timed(
+        minimal_context, args.directory, dockerfile)
+
+    cache_directory = tempfile.mkdtemp()
+    try:
+        cache_path = os.path.join(cache_directory, "digests.json")
+        _, cold_seconds = timed(
+            lambda: dazel.BuildContext(args.directory, dockerfile,
+                                       dazel.DigestCache(cache_path)).digest())
+        _, warm_seconds = timed(
+            lambda: dazel.BuildContext(args.directory, dockerfile,
+                                       dazel.DigestCache(cache_path)).digest())
+    finally:
+        shutil.rmtree(cache_directory)
+
+    json.dump({
+        "full_context": {
+            "files": full_files,
+            "bytes": full_bytes,
+            "seconds": full_seconds,
+        },
+        "minimal_context": {
+            "files": minimal_files,
+            "bytes": minimal_bytes,
+            "seconds": minimal_seconds,
+        },
+        "digest_seconds": {
+            "cold_cache": cold_seconds,
+            "warm_cache": warm_seconds,
+        },
+    }, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""Checks that concurrent dazel invocations start their container once.
+
+Several dazel commands are launched at the same time in a cold workspace (no
+container, no run file), against benchmarks/fake_docker.py. They must all
+succeed, and only one of them may create the container: the others wait on
+the startup lock and reuse it. Each round uses a fresh workspace.
+
+Usage:
+    python benchmarks/concurrent_startup.py [--clients N] [--rounds N]
+        [--latency SECONDS]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from overhead import DAZEL, create_workspace
+
+
+def hammer(clients, latency):
+    """Runs the clients concurrently in a new workspace.
+
+    Returns their exit codes and the number of containers the fake docker
+    created.
+    """
+    root = tempfile.mkdtemp(prefix="dazel-startup-")
+    try:
+        directory = create_workspace(root, {})
+        environment = dict(
+            (name, value) for (name, value) in os.environ.items()
+            if not name.startswith("DAZEL_"))
+        environment.update({
+            "FAKE_DOCKER_STATE": os.path.join(root, "docker.json"),
+            "FAKE_DOCKER_LATENCY": str(latency),
+        })
+        with open(os.devnull, "w") as devnull:
+            processes = [
+                subprocess.Popen([sys.executable, DAZEL, "build", "//..."],
+                                 cwd=directory, env=environment,
+                                 stdout=devnull, stderr=devnull)
+                for _ in range(clients)
+            ]
+            exit_codes = [process.wait() for process in processes]
+        with open(os.path.join(root, "docker.json"), "r") as state_file:
+            # The fake docker numbers the containers it creates.
+            created = json.load(state_file)["ids"]
+        return exit_codes, created
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--clients", type=int, default=16,
+                        help="The number of concurrent dazel commands.")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="The number of cold workspaces to try.")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="The seconds each fake docker command takes.")
+    args = parser.parse_args()
+
+    failures = 0
+    for index in range(args.rounds):
+        exit_codes, created = hammer(args.clients, args.latency)
+        failed = len([rc for rc in exit_codes if rc])
+        ok = created == 1 and not failed
+        failures += not ok
+        sys.stdout.write("Round %d: %d clients, %d failed, %d containers "
+                         "created%s\n" % (index, args.clients, failed, created,
+                                          "" if ok else "  FAILED"))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
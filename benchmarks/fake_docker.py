@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""A scripted stand-in for the docker and docker-compose CLIs.
+
+It keeps the containers, images and networks it "creates" in a JSON state
+file, and answers the commands dazel runs (inspect, run, exec, ps, pull, build,
+network, compose config/up...) the way docker does, after a configurable
+latency. Commands run in containers succeed right away. This lets the overhead
+benchmark measure dazel itself, without docker's (much larger) variance.
+
+Configured through the environment:
+    FAKE_DOCKER_STATE         - the state file (required).
+    FAKE_DOCKER_LATENCY       - the seconds each docker command takes.
+    FAKE_DOCKER_EXEC_LATENCY  - the seconds each command in a container takes.
+
+Usage (as DAZEL_DOCKER_COMMAND, or with "compose" as the compose command):
+    python benchmarks/fake_docker.py [compose] ARGS...
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import time
+
+
+def load_state(path):
+    """Returns the state in the file (empty if there is none yet)."""
+    try:
+        with open(path, "r") as state_file:
+            return json.load(state_file)
+    except (IOError, OSError, ValueError):
+        return {"containers": {}, "images": [], "networks": [], "ids": 0}
+
+
+def save_state(path, state):
+    with open(path, "w") as state_file:
+        json.dump(state, state_file)
+
+
+def option_values(args, option):
+    """Returns the values of the option, given as "--option=v" or "--option v"."""
+    values = []
+    for (index, arg) in enumerate(args):
+        if arg == option and index + 1 < len(args):
+            values.append(args[index + 1])
+        elif arg.startswith(option + "="):
+            values.append(arg[len(option) + 1:])
+    return values
+
+
+def create_container(state, name, image, binds=(), network="default",
+                     labels=None):
+    state["ids"] += 1
+    state["containers"][name] = {
+        "Id": "%064x" % state["ids"],
+        "Image": "sha256:%s" % hashlib.sha256(image.encode()).hexdigest(),
+        "State": {"Running": True},
+        "HostConfig": {"Binds": list(binds), "NetworkMode": network},
+        "Config": {"Image": image, "Labels": labels or {}},
+        "NetworkSettings": {"Networks": {network: {"IPAddress": "10.0.0.%d" %
+                                                   (state["ids"] % 250 + 2)}}},
+    }
+
+
+def image_info(image):
+    digest = hashlib.sha256(image.encode()).hexdigest()
+    return {"Id": "sha256:%s" % digest,
+            "RepoDigests": ["%s@sha256:%s" % (image.split(":")[0], digest)]}
+
+
+def docker(state, args):
+    """Runs the docker command on the state, returning its exit status."""
+    command = args[0] if args else ""
+    containers = state["containers"]
+    if command == "inspect":
+        container = containers.get(args[-1])
+        if container is None:
+            return 1
+        sys.stdout.write("%s\n" % json.dumps([container]))
+    elif command == "image" and args[1:2] == ["inspect"]:
+        if args[-1] not in state["images"]:
+            return 1
+        sys.stdout.write("%s\n" % json.dumps([image_info(args[-1])]))
+    elif command == "network":
+        if args[1] == "inspect":
+            return 0 if args[-1] in state["networks"] else 1
+        if args[1] == "create":
+            state["networks"].append(args[-1])
+    elif command in ("pull", "tag"):
+        state["images"].append(args[-1])
+    elif command == "build":
+        # Read the whole build context, as docker does.
+        if args[-1] == "-":
+            sys.stdin.read()
+        state["images"].extend(option_values(args, "-t"))
+    elif command == "run":
+        name = option_values(args, "--name")[0]
+        positional = [arg for arg in args[1:] if not arg.startswith("-")]
+        values = set(option_values(args, "-v") + option_values(args, "--label") +
+                     option_values(args, "-w") + option_values(args, "-p"))
+        image = [arg for arg in positional if arg not in values][0]
+        labels = dict(label.split("=", 1)
+                      for label in option_values(args, "--label"))
+        networks = option_values(args, "--net") or ["default"]
+        create_container(state, name, image, option_values(args, "-v"),
+                         networks[0], labels)
+    elif command == "stop":
+        if args[-1] not in containers:
+            return 1
+        containers[args[-1]]["State"]["Running"] = False
+    elif command == "rm":
+        return 0 if containers.pop(args[-1], None) else 1
+    elif command == "rename":
+        if args[1] not in containers or args[2] in containers:
+            return 1
+        containers[args[2]] = containers.pop(args[1])
+    elif command == "ps":
+        key, value = option_values(args, "--filter")[0][6:].split("=", 1)
+        label_format = option_values(args, "--format")[0]
+        for (name, container) in sorted(containers.items()):
+            labels = container["Config"]["Labels"]
+            if labels.get(key) == value and container["State"]["Running"]:
+                if "{{.Names}}" in label_format:
+                    sys.stdout.write("%s\n" % name)
+                else:
+                    names = [part.split('"')[1]
+                             for part in label_format.split("{{")[1:]]
+                    sys.stdout.write("%s\n" % "\t".join(
+                        labels.get(name, "") for name in names))
+    return 0
+
+
+def compose(state, args):
+    """Runs the docker-compose command on the state."""
+    project = os.environ.get("COMPOSE_PROJECT_NAME", "default")
+    compose_file = option_values(args, "-f")[0]
+    with open(compose_file, "rb") as f:
+        definition = f.read()
+    args = args[args.index(compose_file) + 1:]
+
+    def config_hash(service):
+        return hashlib.sha256(definition + service.encode()).hexdigest()
+
+    if args[0] == "config":
+        for service in option_values(args, "--hash")[0].split(","):
+            sys.stdout.write("%s %s\n" % (service, config_hash(service)))
+    elif args[0] == "up":
+        network = "%s_default" % project
+        if network not in state["networks"]:
+            state["networks"].append(network)
+        for service in [arg for arg in args[1:] if not arg.startswith("-")]:
+            create_container(
+                state, "%s_%s_1" % (project, service), service,
+                network=network, labels={
+                    "com.docker.compose.project": project,
+                    "com.docker.compose.service": service,
+                    "com.docker.compose.config-hash": config_hash(service),
+                    "com.docker.compose.oneoff": "False",
+                })
+    return 0
+
+
+def main():
+    state_path = os.environ["FAKE_DOCKER_STATE"]
+    time.sleep(float(os.environ.get("FAKE_DOCKER_LATENCY", "0")))
+    # Commands in containers don't touch the state (and may run concurrently).
+    if sys.argv[1:2] == ["exec"]:
+        time.sleep(float(os.environ.get("FAKE_DOCKER_EXEC_LATENCY", "0")))
+        return 0
+    with open(state_path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        state = load_state(state_path)
+        if sys.argv[1:2] == ["compose"]:
+            rc = compose(state, sys.argv[2:])
+        else:
+            rc = docker(state, sys.argv[1:])
+        save_state(state_path, state)
+    return rc
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Merges dazel's trace (DAZEL_TRACE) with bazel's --profile into one file.
+
+The timestamps of both are relative to the start of their own process: dazel
+records its start in the "otherData" of its trace (as "start_ts", in
+microseconds since the epoch), but bazel's profile only records its start to
+the second. Unless it is given with --bazel_start_ts, bazel's start is taken
+to be when dazel ran the bazel command (the start of its first "command"
+span), which leaves out the latency of `docker exec` and of the bazel client.
+dazel's events are shifted onto bazel's timeline, and the merged trace can be
+loaded in chrome://tracing or Perfetto.
+
+Usage:
+    python benchmarks/merge_traces.py DAZEL_TRACE BAZEL_PROFILE
+        [--bazel_start_ts MICROSECONDS] [--output FILE]
+"""
+
+import argparse
+import gzip
+import json
+import sys
+
+
+def load_trace(path):
+    """Loads a trace file (optionally gzipped, like bazel's profiles)."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as trace_file:
+        trace = json.loads(trace_file.read().decode("utf-8"))
+    # The trace event format also allows a bare array of events.
+    if isinstance(trace, list):
+        trace = {"traceEvents": trace}
+    return trace
+
+
+def merge(dazel_trace, bazel_profile, bazel_start_ts=None):
+    """Returns bazel's profile with dazel's events on its timeline."""
+    dazel_start_ts = dazel_trace.get("otherData", {}).get("start_ts")
+    if dazel_start_ts is None:
+        raise ValueError("The dazel trace has no start time (it was written "
+                         "by an older dazel).")
+    events = dazel_trace.get("traceEvents") or []
+    if bazel_start_ts is None:
+        commands = [e["ts"] for e in events if e.get("cat") == "command"]
+        if not commands:
+            raise ValueError("The dazel trace has no command to align bazel's "
+                             "profile with: use --bazel_start_ts.")
+        bazel_start_ts = dazel_start_ts + min(commands)
+
+    offset = dazel_start_ts - bazel_start_ts
+    merged = dict(bazel_profile)
+    merged["traceEvents"] = list(bazel_profile.get("traceEvents") or [])
+    for event in events:
+        event = dict(event)
+        if "ts" in event:
+            event["ts"] += offset
+        merged["traceEvents"].append(event)
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("dazel_trace", help="The trace file of DAZEL_TRACE.")
+    parser.add_argument("bazel_profile",
+                        help="The profile of bazel's --profile (or the "
+                        "command.profile.gz of its output base).")
+    parser.add_argument("--bazel_start_ts", type=int,
+                        help="When bazel started, in microseconds since the "
+                        "epoch.")
+    parser.add_argument("--output",
+                        help="Where to write the merged trace (defaults to "
+                        "stdout).")
+    args = parser.parse_args()
+
+    try:
+        merged = merge(load_trace(args.dazel_trace),
+                       load_trace(args.bazel_profile), args.bazel_start_ts)
+    except ValueError as e:
+        sys.stderr.write("ERROR: %s\n" % e)
+        return 1
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(merged, output_file)
+    else:
+        json.dump(merged, sys.stdout)
+        sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
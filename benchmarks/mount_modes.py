@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Compares bazel build times under each of dazel's mount modes.
+
+For every mode, this starts the container with the matching
+DAZEL_MOUNT_MODES (which is not timed), then times a clean build of the
+target and an incremental (null) build. In sync mode, the time to copy
+bazel-bin back to the host is reported separately. This runs real builds,
+so it needs docker and a workspace with a dazel configuration.
+
+Usage:
+    python benchmarks/mount_modes.py --directory DIR --target //some:target
+        [--runs N]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+DAZEL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                     "dazel.py")
+
+# The DAZEL_MOUNT_MODES of each benchmarked mode.
+MODES = {
+    "bind": "",
+    "volume": "execroot=volume;action_cache=volume",
+    "tmpfs_sandbox": "sandbox=tmpfs",
+    "volume_and_tmpfs_sandbox":
+        "execroot=volume;action_cache=volume;sandbox=tmpfs",
+    "sync": "execroot=sync;action_cache=volume;sandbox=tmpfs",
+}
+
+
+def dazel(directory, mount_modes, *args):
+    """Runs dazel in the directory, returning its wall time in seconds."""
+    environment = dict(os.environ, DAZEL_MOUNT_MODES=mount_modes)
+    start = time.time()
+    with open(os.devnull, "w") as devnull:
+        rc = subprocess.call([sys.executable, DAZEL] + list(args),
+                             cwd=directory, env=environment, stdout=devnull,
+                             stderr=devnull)
+    if rc:
+        raise RuntimeError("'dazel %s' failed (rc=%d) with "
+                           "DAZEL_MOUNT_MODES='%s'" %
+                           (" ".join(args), rc, mount_modes))
+    return time.time() - start
+
+
+def benchmark(directory, target, mount_modes, runs):
+    """Returns the best clean and null build times of the mode."""
+    # Start the container (and the bazel server) with this mode.
+    dazel(directory, mount_modes, "info")
+
+    clean_builds, null_builds, syncs = [], [], []
+    for _ in range(runs):
+        dazel(directory, mount_modes, "clean")
+        clean_builds.append(dazel(directory, mount_modes, "build", target))
+        null_builds.append(dazel(directory, mount_modes, "build", target))
+        if "execroot=sync" in mount_modes:
+            syncs.append(dazel(directory, mount_modes, "sync-outputs"))
+
+    result = {
+        "clean_build_seconds": min(clean_builds),
+        "null_build_seconds": min(null_builds),
+    }
+    if syncs:
+        result["sync_seconds"] = min(syncs)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--directory", default=os.getcwd(),
+                        help="The workspace directory.")
+    parser.add_argument("--target", required=True,
+                        help="The target to build.")
+    parser.add_argument("--runs", type=int, default=3,
+                        help="The number of builds per mode (the best counts).")
+    parser.add_argument("--modes", default=",".join(sorted(MODES)),
+                        help="The comma-separated modes to benchmark.")
+    args = parser.parse_args()
+
+    results = {}
+    for mode in args.modes.split(","):
+        results[mode] = benchmark(args.directory, args.target, MODES[mode],
+                                  args.runs)
+
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
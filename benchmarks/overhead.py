@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""Measures dazel's own overhead against a fake docker.
+
+Each scenario creates a workspace with its own .dazelrc, pointing dazel at
+benchmarks/fake_docker.py (which answers docker commands after a fixed
+latency), and times a cold invocation (no container, no run file) followed by
+a warm one (the container is running, and the run file is fresh). Besides the
+wall time of the whole process, dazel's trace (DAZEL_TRACE) gives the time
+spent in each phase: main() as a whole, from_config, is_running, start and
+send_command, and the number of docker calls.
+
+The results are JSON, which can be stored as a baseline and compared against
+later, to judge changes to dazel.py:
+    python benchmarks/overhead.py > baseline.json
+    python benchmarks/overhead.py --compare baseline.json
+
+Usage:
+    python benchmarks/overhead.py [--runs N] [--latency SECONDS]
+        [--scenarios NAME,...] [--output FILE]
+        [--compare BASELINE [RESULTS]] [--threshold FRACTION]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+DAZEL = os.path.join(BENCHMARKS, "..", "dazel.py")
+FAKE_DOCKER = os.path.join(BENCHMARKS, "fake_docker.py")
+
+# What each scenario adds to a minimal workspace: the depth of the directory
+# dazel runs from, and the number of volumes, run dependencies and
+# docker-compose services.
+SCENARIOS = {
+    "minimal": {},
+    "deep_workspace": {"depth": 16},
+    "many_volumes": {"volumes": 32},
+    "run_deps": {"run_deps": 4},
+    "compose_services": {"compose_services": 4},
+}
+
+# The traced phases that are reported (summed over their calls).
+PHASES = ["from_config", "is_running", "start", "send_command"]
+
+# Changes smaller than this many seconds are noise, whatever their ratio.
+MIN_REGRESSION_SECONDS = 0.005
+
+
+def create_workspace(root, scenario):
+    """Creates the scenario's workspace, returning the directory to run in."""
+    workspace = os.path.join(root, "workspace")
+    os.makedirs(workspace)
+    open(os.path.join(workspace, "WORKSPACE"), "w").close()
+    fake_docker = "%s %s" % (sys.executable, FAKE_DOCKER)
+    config = {
+        "DAZEL_DOCKER_COMMAND": fake_docker,
+        "DAZEL_DOCKER_EXEC_COMMAND": fake_docker,
+        "DAZEL_DOCKER_TRANSPORT": "cli",
+        "DAZEL_CACHE_DIRECTORY": os.path.join(root, "cache"),
+        "DAZEL_BAZEL_USER_OUTPUT_ROOT": os.path.join(root, "output"),
+        "DAZEL_RUN_FILE": ".dazel_run",
+    }
+
+    volumes = []
+    for index in range(scenario.get("volumes", 0)):
+        volume = os.path.join(root, "volumes", str(index))
+        os.makedirs(volume)
+        volumes.append("%s:/volumes/%d" % (volume, index))
+    config["DAZEL_VOLUMES"] = volumes
+    config["DAZEL_RUN_DEPS"] = [
+        "dependency%d:latest" % index
+        for index in range(scenario.get("run_deps", 0))
+    ]
+
+    services = ["service%d" % index
+                for index in range(scenario.get("compose_services", 0))]
+    if services:
+        with open(os.path.join(workspace, "docker-compose.yml"), "w") as f:
+            f.write("services:\n")
+            for service in services:
+                f.write("  %s:\n    image: %s:latest\n" % (service, service))
+        config["DAZEL_DOCKER_COMPOSE_FILE"] = os.path.join(
+            workspace, "docker-compose.yml")
+        config["DAZEL_DOCKER_COMPOSE_COMMAND"] = "%s compose" % fake_docker
+        config["DAZEL_DOCKER_COMPOSE_SERVICES"] = services
+
+    with open(os.path.join(workspace, ".dazelrc"), "w") as dazelrc:
+        for (name, value) in sorted(config.items()):
+            dazelrc.write("%s = %r\n" % (name, value))
+
+    directory = workspace
+    for index in range(scenario.get("depth", 0)):
+        directory = os.path.join(directory, "level%d" % index)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return directory
+
+
+def dazel(directory, root, latency):
+    """Runs a dazel command, returning its wall time, phases and docker calls."""
+    trace_path = os.path.join(root, "trace.json")
+    environment = dict(
+        (name, value) for (name, value) in os.environ.items()
+        if not name.startswith("DAZEL_"))
+    environment.update({
+        "DAZEL_TRACE": trace_path,
+        "FAKE_DOCKER_STATE": os.path.join(root, "docker.json"),
+        "FAKE_DOCKER_LATENCY": str(latency),
+    })
+    start = time.time()
+    with open(os.devnull, "w") as devnull:
+        rc = subprocess.call([sys.executable, DAZEL, "build", "//..."],
+                             cwd=directory, env=environment, stdout=devnull,
+                             stderr=devnull)
+    wall_time = time.time() - start
+    if rc:
+        raise RuntimeError("dazel failed (rc=%d) in '%s'" % (rc, directory))
+
+    with open(trace_path, "r") as trace_file:
+        events = [event for event in json.load(trace_file)["traceEvents"]
+                  if event["ph"] == "X"]
+    result = {"wall_seconds": wall_time}
+    result["main_seconds"] = sum(
+        event["dur"] for event in events if event["name"] == "dazel") / 1e6
+    for phase in PHASES:
+        result["%s_seconds" % phase] = sum(
+            event["dur"] for event in events if event["name"] == phase) / 1e6
+    result["docker_calls"] = len(
+        [event for event in events if event["cat"] == "docker"])
+    return result
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def benchmark(scenario, runs, latency):
+    """Returns the median cold and warm measurements of the scenario."""
+    samples = {"cold": [], "warm": []}
+    for _ in range(runs):
+        root = tempfile.mkdtemp(prefix="dazel-overhead-")
+        try:
+            directory = create_workspace(root, scenario)
+            samples["cold"].append(dazel(directory, root, latency))
+            samples["warm"].append(dazel(directory, root, latency))
+        finally:
+            shutil.rmtree(root)
+    return dict(
+        (path, dict((metric, median([sample[metric] for sample in results]))
+                    for metric in results[0]))
+        for (path, results) in samples.items())
+
+
+def compare(baseline, results, threshold):
+    """Prints how the results changed, returning the number of regressions."""
+    regressions = 0
+    sys.stdout.write("%-40s %12s %12s %9s\n" %
+                     ("metric", "baseline", "current", "change"))
+    for scenario in sorted(results["scenarios"]):
+        if scenario not in baseline["scenarios"]:
+            continue
+        for path in sorted(results["scenarios"][scenario]):
+            old = baseline["scenarios"][scenario].get(path, {})
+            new = results["scenarios"][scenario][path]
+            for metric in sorted(new):
+                if metric not in old:
+                    continue
+                if old[metric]:
+                    change = (new[metric] - old[metric]) / float(old[metric])
+                else:
+                    change = float("inf") if new[metric] else 0.0
+                regressed = (change > threshold and
+                             (metric == "docker_calls" or new[metric] -
+                              old[metric] > MIN_REGRESSION_SECONDS))
+                regressions += regressed
+                sys.stdout.write("%-40s %12.4g %12.4g %+8.1f%%%s\n" % (
+                    "%s.%s.%s" % (scenario, path, metric), old[metric],
+                    new[metric], change * 100, "  REGRESSION"
+                    if regressed else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=5,
+                        help="The number of runs per scenario (the median "
+                        "counts).")
+    parser.add_argument("--latency", type=float, default=0.01,
+                        help="The seconds each fake docker command takes.")
+    parser.add_argument("--scenarios", default=",".join(sorted(SCENARIOS)),
+                        help="The comma-separated scenarios to benchmark.")
+    parser.add_argument("--output",
+                        help="The file to write the results to (default: "
+                        "stdout, unless comparing).")
+    parser.add_argument("--compare", nargs="+", metavar="FILE",
+                        help="Compare against a baseline (with the results "
+                        "of a new run, or the given results file).")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="The relative slowdown that counts as a "
+                        "regression when comparing.")
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) > 1:
+        with open(args.compare[1], "r") as results_file:
+            results = json.load(results_file)
+    else:
+        results = {
+            "runs": args.runs,
+            "latency": args.latency,
+            "scenarios": dict(
+                (name, benchmark(SCENARIOS[name], args.runs, args.latency))
+                for name in args.scenarios.split(",")),
+        }
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    elif not args.compare:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    if args.compare:
+        with open(args.compare[0], "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        return 1 if compare(baseline, results, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,70 @@
 #!/usr/bin/env python
 
+import atexit
+import base64
+import binascii
+import calendar
+import errno
+import fcntl
+import functools
+import glob
 import hashlib
+import json
 import logging
 import os
+import re
+import select
+import shlex
 import shutil
+import signal
+import socket
+import struct
 import subprocess
 import sys
-import types
+import tarfile
+import threading
+import time
+
+try:
+    from collections.abc import Iterable
+except ImportError:  # Python 2
+    from collections import Iterable
+
+try:
+    import http.client as httplib
+except ImportError:  # Python 2
+    import httplib
+
+try:
+    from shlex import quote as shell_quote
+except ImportError:  # Python 2
+    from pipes import quote as shell_quote
+
+try:
+    from urllib.parse import quote, urlencode, urlparse
+    from urllib.request import urlopen
+except ImportError:  # Python 2
+    from urllib import quote, urlencode
+    from urllib2 import urlopen
+    from urlparse import urlparse
 
 DAZEL_RC_FILE = ".dazelrc"
 DAZEL_RUN_FILE = ".dazel_run"
-BAZEL_WORKSPACE_FILE = "WORKSPACE"
+DAZEL_RUN_FILE_VERSION = 2
+DAZEL_CONFIG_CACHE_FILE = ".dazel_config"
+DAZEL_CONFIG_CACHE_VERSION = 1
+DOCKER_IGNORE_FILE = ".dockerignore"
+# The name of the Dockerfile inside the build context streamed to docker.
+BUILD_CONTEXT_DOCKERFILE = ".dazel.Dockerfile"
+# The heredocs of a Dockerfile instruction (e.g. "COPY <<EOF /file"), whose
+# contents follow it up to the delimiter line.
+HEREDOC_REGEX = re.compile(r"<<-?[\"']?(\w+)[\"']?")
+# A variable in a Dockerfile instruction: $NAME, ${NAME} or ${NAME:-default}.
+DOCKERFILE_VARIABLE_REGEX = re.compile(r"\$(?:\{(\w+)(?::-([^}]*))?\}|(\w+))")
+# The files that mark the root of a bazel workspace.
+BAZEL_WORKSPACE_FILES = ["WORKSPACE", "WORKSPACE.bazel", "MODULE.bazel"]
+# The maximum number of directories remembered in the workspace memo.
+WORKSPACE_MEMO_SIZE = 1000
 
 DEFAULT_INSTANCE_NAME = "dazel"
 DEFAULT_IMAGE_NAME = "dazel"
@@ -35,13 +89,1593 @@ DEFAULT_BAZEL_USER_OUTPUT_ROOT = os.path.expanduser(
 TEMP_BAZEL_OUTPUT_USER_ROOT = (
     "/var/bazel/workspace/_bazel_%s" % os.environ.get("USER", "user"))
 DEFAULT_BAZEL_USER_OUTPUT_PATHS = ["external", "action_cache", "execroot"]
+DEFAULT_MOUNT_MODES = {}
+DEFAULT_IMAGE_PIN_TTL = 24 * 60 * 60
+# How the paths in the output base can be mounted into the container.
+MOUNT_MODES = ["bind", "volume", "tmpfs", "sync"]
+# The paths in the output base (besides the user output paths) that can be
+# given a mount mode.
+MOUNT_MODE_EXTRA_PATHS = ["sandbox"]
+DEFAULT_RESOURCES = {}
+# The limits a resource profile can set on the container ("share" divides the
+# automatically sized limits between that many containers).
+RESOURCE_KEYS = ["cpus", "memory", "shm", "share"]
+# The fraction of the available memory (and of the container's memory for
+# /dev/shm) that an automatically sized container gets.
+AUTO_RESOURCES_MEMORY_FRACTION = 0.75
+AUTO_RESOURCES_SHM_FRACTION = 0.25
+# The fraction of the container's memory that bazel schedules actions against
+# (bazel's own default fraction of the host's memory).
+BAZEL_RAM_RESOURCES_FRACTION = 0.67
+# The docker hosts that `dazel test --shards=N` runs shards on, in turn (""
+# being the local docker daemon).
+DEFAULT_SHARD_HOSTS = []
+# The duration assumed for tests that haven't run yet, when there is no history
+# at all to estimate it from.
+DEFAULT_TEST_DURATION = 1.0
+# A test result line of bazel's test summary, e.g.
+# "//foo:bar_test    (cached) PASSED in 1.2s".
+TEST_SUMMARY_REGEX = re.compile(
+    r"^([/@]\S+)\s+(\(cached\) )?([A-Z][A-Z ]*[A-Z])\b(?:.* in ([\d.]+)s)?\s*$")
 DEFAULT_BAZEL_RC_FILE = ""
 DEFAULT_DOCKER_RUN_PRIVILEGED = False
 DEFAULT_DOCKER_MACHINE = None
 DEFAULT_WORKSPACE_HEX = False
+DEFAULT_DOCKER_TRANSPORT = "auto"
+DEFAULT_CACHE_DIRECTORY = os.path.expanduser("~/.cache/dazel")
+DEFAULT_SERVER_IDLE_TIMEOUT = 3 * 60 * 60
+DEFAULT_GC_IDLE_TIMEOUT = 3 * 60 * 60
+DEFAULT_GC_MAX_SIZE = ""
+DEFAULT_GC_INTERVAL = 0
+DEFAULT_BUILD_REPORT = False
+# The bazel commands that dazel reports the performance of, with
+# DAZEL_BUILD_REPORT.
+BUILD_REPORT_COMMANDS = ["build", "test", "run", "coverage", "mobile-install"]
+# The history of build reports, in the cache directory (one JSON line each).
+BUILD_HISTORY_FILE = "build_history.jsonl"
+# The number of slowest actions and targets in a build report.
+BUILD_REPORT_TOP = 5
+# The number of previous builds (of the same command) that `dazel report`
+# compares each build against, and the slowdown that counts as a regression.
+BUILD_REPORT_BASELINE_SIZE = 10
+BUILD_REPORT_REGRESSION_THRESHOLD = 0.2
+# The critical path line of bazel's "critical path" build tool log.
+CRITICAL_PATH_REGEX = re.compile(r"Critical Path: ([\d.]+)s")
+DEFAULT_STARTUP_CONCURRENCY = 4
+DEFAULT_STARTUP_LOCK_TIMEOUT = 10 * 60
+DEFAULT_RUN_DEPS_READINESS = {}
+DEFAULT_READINESS_TIMEOUT = 120
+READINESS_INITIAL_INTERVAL = 0.1
+READINESS_MAX_INTERVAL = 2
+DEFAULT_BAZEL_WARMUP = False
+DEFAULT_SHARED_CACHE_DIRECTORY = ""
+DEFAULT_SHARED_CACHE_MAX_SIZE = "50G"
+SHARED_CACHE_LOCK_TIMEOUT = 60
+DEFAULT_REMOTE_CACHE = False
+DEFAULT_REMOTE_CACHE_IMAGE = "buchgr/bazel-remote-cache"
+DEFAULT_REMOTE_CACHE_DIRECTORY = ""
+DEFAULT_REMOTE_CACHE_MAX_SIZE = 10
+DEFAULT_REMOTE_CACHE_URL = ""
+# The ports that the bazel-remote image serves HTTP and gRPC on.
+REMOTE_CACHE_HTTP_PORT = 8080
+REMOTE_CACHE_GRPC_PORT = 9092
+REMOTE_CACHE_METRICS_TIMEOUT = 1
+# The bazel commands that don't build anything, which `dazel batch --jobs` may
+# run concurrently.
+READ_ONLY_COMMANDS = ["query", "cquery", "aquery", "info", "version", "help"]
+# The bazel commands that take --repository_cache and --disk_cache.
+REPOSITORY_CACHE_COMMANDS = [
+    "build", "test", "run", "coverage", "cquery", "aquery", "mobile-install",
+    "fetch", "sync"
+]
+DISK_CACHE_COMMANDS = [
+    "build", "test", "run", "coverage", "cquery", "aquery", "mobile-install"
+]
+# The prefix of the files in the container that commands write their pid to,
+# for dazel to relay signals to them.
+PID_FILE_PREFIX = "/tmp/.dazel-"
+# The minimum number of seconds between removals of the pid files of the
+# commands that are gone, in each container.
+PID_FILE_CLEANUP_INTERVAL = 3600
+DEFAULT_POOL_SIZE = 0
+DEFAULT_POOL_ROOT = ""
+DEFAULT_POOL_MAX_INSTANCES = 8
+POOL_LABEL = "dazel.pool"
+SERVER_START_TIMEOUT = 10
+DEFAULT_DOCKER_HOST = "unix:///var/run/docker.sock"
+DOCKER_API_TIMEOUT = 60
+
+# The resolved configuration attributes that define the running container. If
+# any of them change, the container has to be started again.
+CONTAINER_FINGERPRINT_ATTRIBUTES = [
+    "instance_name", "image_name", "repository", "run_command", "dockerfile",
+    "directory", "volumes", "ports", "network", "run_deps",
+    "docker_compose_file", "docker_compose_project_name",
+    "docker_compose_services", "docker_run_privileged", "remote_cache",
+    "remote_cache_image", "remote_cache_url", "resources"
+]
 
 logger = logging.getLogger("dazel")
 
+# Cache of executable lookups, so that we only walk the PATH once per process.
+_executable_cache = {}
+
+# Cache of workspace lookups, so that we only walk up once per process.
+_workspace_directory_cache = {}
+
+
+def _command_exists(cmd):
+    """Checks if a command exists on the system (like 'which', without a fork)."""
+    if not cmd:
+        return False
+    executable = cmd.split()[0]
+    if executable not in _executable_cache:
+        if os.path.dirname(executable):
+            paths = [executable]
+        else:
+            paths = [
+                os.path.join(directory, executable) for directory in
+                os.environ.get("PATH", os.defpath).split(os.pathsep)
+            ]
+        _executable_cache[executable] = any(
+            os.path.isfile(path) and os.access(path, os.X_OK)
+            for path in paths)
+    return _executable_cache[executable]
+
+
+def _write_json_file(path, value):
+    """Writes the value as JSON atomically (readers never see partial files)."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temp_path, "w") as json_file:
+        json.dump(value, json_file, indent=2, sort_keys=True)
+    os.rename(temp_path, path)
+
+
+def _normalize_cache_directory(cache_directory):
+    """Returns the absolute cache directory, with "~" expanded.
+
+    The cache directory holds host-wide state (locks, instance records...), so
+    it must not depend on the directory dazel runs in.
+    """
+    return os.path.abspath(os.path.expanduser(cache_directory))
+
+
+def _same_file(open_file, path):
+    """Checks if the open file is (still) the one at the path."""
+    try:
+        return os.path.samestat(os.fstat(open_file.fileno()), os.stat(path))
+    except OSError:
+        return False
+
+
+class Tracer(object):
+    """Records the timing of dazel's phases as Chrome trace events.
+
+    Tracing is enabled by setting DAZEL_TRACE (in the environment only, since
+    it also covers reading the configuration) to the path of the trace file.
+    The file uses the trace event format of bazel's --profile. Like bazel's,
+    its timestamps are relative to the start of the process, whose time since
+    the epoch is recorded in "otherData" (as "start_ts", in microseconds) so
+    that the two can be aligned (see benchmarks/merge_traces.py) and loaded
+    together in chrome://tracing or Perfetto.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.start = time.time()
+        self.events = []
+        self._thread_ids = {}
+
+    @classmethod
+    def from_environment(cls):
+        """Returns a tracer if DAZEL_TRACE is set, or None."""
+        path = os.environ.get("DAZEL_TRACE")
+        return cls(os.path.abspath(path)) if path else None
+
+    def add(self, name, category, start, end, args=None):
+        """Records a complete span."""
+        thread = threading.current_thread().ident
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": int((start - self.start) * 1e6),
+            "dur": int((end - start) * 1e6),
+            "pid": os.getpid(),
+            "tid": self._thread_ids.setdefault(thread, len(self._thread_ids)),
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def write(self):
+        """Writes the trace file, and a one-line summary to stderr."""
+        end = time.time()
+        self.add("dazel", "dazel", self.start, end, {"argv": sys.argv[1:]})
+        metadata = [{
+            "name": "process_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "args": {"name": "dazel"}
+        }] + [{
+            "name": "thread_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "tid": tid,
+            "args": {"name": "dazel-%d" % tid}
+        } for tid in sorted(self._thread_ids.values())]
+        try:
+            _write_json_file(self.path, {
+                "otherData": {
+                    "tool": "dazel",
+                    "start_ts": int(self.start * 1e6)
+                },
+                "displayTimeUnit": "ms",
+                "traceEvents": metadata + self.events,
+            })
+        except (IOError, OSError) as e:
+            logger.error("ERROR: Could not write the trace file: %s" % e)
+        sys.stderr.write("%s\n" % self.summary(end - self.start))
+
+    def summary(self, total):
+        """Returns where the time went, in one line."""
+        docker = [e for e in self.events if e["cat"] == "docker"]
+        command = [e for e in self.events if e["cat"] == "command"]
+        return ("dazel: %.3fs total, %.3fs in dazel, %.3fs in %d docker calls, "
+                "%.3fs in the command (trace: %s)" % (
+                    total, max(total - self._wall_time(docker + command), 0),
+                    self._wall_time(docker), len(docker),
+                    self._wall_time(command), self.path))
+
+    @staticmethod
+    def _wall_time(events):
+        """Returns the time covered by the spans, which may run concurrently."""
+        wall_time = 0
+        end = None
+        for event in sorted(events, key=lambda e: e["ts"]):
+            event_end = event["ts"] + event["dur"]
+            if end is None or event["ts"] >= end:
+                wall_time += event["dur"]
+                end = event_end
+            elif event_end > end:
+                wall_time += event_end - end
+                end = event_end
+        return wall_time / 1e6
+
+
+class _Span(object):
+    """Records the time spent in a with-block to the tracer."""
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.add(self.name, self.category, self.start, time.time(),
+                        self.args)
+
+
+class _NullSpan(object):
+    """Stands in for a span when tracing is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_tracer = Tracer.from_environment()
+# When this dazel process started, to tell its own overhead from bazel's time.
+_start_time = time.time()
+_null_span = _NullSpan()
+
+
+def _span(name, category, args=None):
+    """Returns a context manager that traces its block (if tracing is on)."""
+    if _tracer is None:
+        return _null_span
+    return _Span(_tracer, name, category, args)
+
+
+def traced(category):
+    """Decorates a function to trace its calls (if tracing is on).
+
+    When tracing is off, the function is returned as is, so that untraced runs
+    pay nothing.
+    """
+    def decorator(function):
+        if _tracer is None:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _Span(_tracer, function.__name__, category, None):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class DockerIgnore(object):
+    """Matches context paths against the patterns of a .dockerignore file.
+
+    This follows the docker semantics: patterns are relative to the context
+    root, '**' matches any number of directories, a pattern matching a
+    directory excludes everything under it, and the last matching pattern
+    (possibly an exception starting with '!') wins.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            exception = pattern.startswith("!")
+            if exception:
+                pattern = pattern[1:].strip()
+            pattern = os.path.normpath(pattern).lstrip("/")
+            self.patterns.append((self._compile(pattern), exception))
+        self.has_exceptions = any(exception for (_, exception) in self.patterns)
+
+    @classmethod
+    def from_directory(cls, directory):
+        """Reads the .dockerignore file of the given context directory."""
+        try:
+            with open(os.path.join(directory, DOCKER_IGNORE_FILE), "r") as f:
+                return cls(f.read().splitlines())
+        except (IOError, OSError):
+            return cls([])
+
+    def is_ignored(self, path):
+        """Checks if the relative path is excluded from the build context."""
+        parents = []
+        parent = os.path.dirname(path)
+        while parent:
+            parents.append(parent)
+            parent = os.path.dirname(parent)
+
+        ignored = False
+        for (regex, exception) in self.patterns:
+            if regex.match(path) or any(regex.match(p) for p in parents):
+                ignored = not exception
+        return ignored
+
+    @staticmethod
+    def _compile(pattern):
+        regex = ""
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith("**/", i):
+                regex += "(?:.*/)?"
+                i += 3
+            elif pattern.startswith("**", i):
+                regex += ".*"
+                i += 2
+            elif pattern[i] == "*":
+                regex += "[^/]*"
+                i += 1
+            elif pattern[i] == "?":
+                regex += "[^/]"
+                i += 1
+            elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+                end = pattern.index("]", i + 1)
+                regex += "[%s]" % pattern[i + 1:end].replace("!", "^", 1)
+                i = end + 1
+            else:
+                regex += re.escape(pattern[i])
+                i += 1
+        return re.compile(regex + "$")
+
+
+class BuildContext(object):
+    """The part of the build context that a Dockerfile actually uses.
+
+    The files are found from the sources of the COPY and ADD instructions of the
+    Dockerfile, honoring the .dockerignore file of the context directory, and
+    their contents (along with the Dockerfile itself) make up the digest that
+    identifies the image built from them. Variables in the sources are
+    replaced with the values of the ARG and ENV instructions before them.
+    Sources that still can't be resolved are left out of the digest (with a
+    warning), and the whole directory is streamed to docker instead when
+    building, so that the build still finds them.
+    """
+
+    def __init__(self, directory, dockerfile, digest_cache=None, excluded=()):
+        self.directory = os.path.realpath(directory)
+        self.dockerfile = dockerfile
+        self.digest_cache = digest_cache
+        # dazel's own files in the directory (such as the run file), which
+        # change on every start, and are never part of the context.
+        self.excluded = set(
+            os.path.relpath(os.path.realpath(path), self.directory)
+            for path in excluded)
+        self._files = None
+        self._unresolved = []
+        self._digest = None
+
+    def sources(self):
+        """Returns the context sources of the COPY and ADD instructions.
+
+        Sources with variables that have no value are returned as is. The
+        contents of heredocs are in the Dockerfile itself, so they are skipped.
+        """
+        with open(self.dockerfile, "r") as f:
+            lines = f.read().splitlines()
+
+        # Join continuation lines and drop comments and heredoc contents to get
+        # whole instructions.
+        instructions = []
+        current = ""
+        heredocs = []
+        for line in lines:
+            if heredocs:
+                if line.strip() == heredocs[0]:
+                    heredocs.pop(0)
+                continue
+            if not current and line.strip().startswith("#"):
+                continue
+            if line.rstrip().endswith("\\"):
+                current += line.rstrip()[:-1] + " "
+                continue
+            instructions.append(current + line)
+            heredocs = HEREDOC_REGEX.findall(current + line)
+            current = ""
+        if current:
+            instructions.append(current)
+
+        sources = []
+        variables = {}
+        for instruction in instructions:
+            parts = instruction.strip().split(None, 1)
+            if len(parts) < 2:
+                continue
+            if parts[0].upper() in ("ARG", "ENV"):
+                variables.update(_dockerfile_assignments(parts[0].upper(),
+                                                         parts[1]))
+                continue
+            if parts[0].upper() not in ("COPY", "ADD"):
+                continue
+            arguments = parts[1].strip()
+            flags = []
+            while arguments.startswith("--"):
+                flag, _, arguments = arguments.partition(" ")
+                flags.append(flag)
+                arguments = arguments.strip()
+            # Copying from another stage or image doesn't use the context.
+            if any(flag.startswith("--from") for flag in flags):
+                continue
+            if arguments.startswith("["):
+                try:
+                    paths = json.loads(arguments)
+                except ValueError:
+                    paths = arguments.split()
+            else:
+                paths = arguments.split()
+            sources += [
+                _substitute_variables(path, variables) for path in paths[:-1]
+                if "://" not in path and not path.startswith(("git@", "<<"))
+            ]
+        return sources
+
+    def files(self):
+        """Returns the sorted relative paths of the context files in use."""
+        if self._files is not None:
+            return self._files
+
+        ignore = DockerIgnore.from_directory(self.directory)
+        files = set()
+        self._unresolved = []
+        for source in self.sources():
+            if "$" in source:
+                self._unresolved.append(source)
+                continue
+            source = os.path.normpath(source).lstrip("/")
+            if source in (".", ""):
+                matches = [self.directory]
+            else:
+                matches = glob.glob(os.path.join(self.directory, source))
+            for match in matches:
+                if os.path.isdir(match):
+                    files.update(self._walk(match, ignore))
+                elif os.path.isfile(match):
+                    path = os.path.relpath(match, self.directory)
+                    if not ignore.is_ignored(path) and not self._is_excluded(
+                            path):
+                        files.add(path)
+        if self._unresolved:
+            logger.warning("WARNING: Could not resolve the COPY/ADD sources %s "
+                           "of '%s': changes to their files won't rebuild the "
+                           "image." % (", ".join(self._unresolved),
+                                       self.dockerfile))
+        self._files = sorted(files)
+        return self._files
+
+    def digest(self):
+        """Returns the content digest of the Dockerfile and its context files."""
+        if self._digest is not None:
+            return self._digest
+
+        file_digest = (self.digest_cache.digest
+                       if self.digest_cache else _file_digest)
+        digest = hashlib.sha256()
+        digest.update(_file_digest(self.dockerfile).encode("ascii"))
+        for path in self.files():
+            real_path = os.path.join(self.directory, path)
+            executable = os.access(real_path, os.X_OK)
+            digest.update(("\0%s\0%d\0%s" % (
+                path, executable, file_digest(real_path))).encode("utf-8"))
+        if self.digest_cache:
+            self.digest_cache.save()
+        self._digest = digest.hexdigest()
+        return self._digest
+
+    def stamp(self):
+        """Returns a cheap fingerprint of the context, to tell if it changed.
+
+        It covers the stats of the Dockerfile, its .dockerignore and the COPY
+        and ADD sources themselves, without walking their directories: adding
+        or removing files at the top of a copied directory changes it, but
+        editing files under it doesn't. Directories are listed rather than
+        stat'ed, since dazel's own files in them change on every command.
+        """
+        paths = [self.dockerfile,
+                 os.path.join(self.directory, DOCKER_IGNORE_FILE)]
+        for source in self.sources():
+            path = os.path.join(self.directory,
+                                os.path.normpath(source).lstrip("/"))
+            paths += sorted(glob.glob(path)) or [path]
+        stats = []
+        for path in paths:
+            try:
+                if os.path.isdir(path):
+                    relative_path = os.path.relpath(path, self.directory)
+                    stats.append([path, sorted(
+                        name for name in os.listdir(path)
+                        if not self._is_excluded(os.path.normpath(
+                            os.path.join(relative_path, name))))])
+                else:
+                    stat = os.stat(path)
+                    stats.append([path, stat.st_mtime, stat.st_size,
+                                  stat.st_ino])
+            except OSError:
+                stats.append([path, None])
+        return hashlib.sha1(json.dumps(stats).encode("utf-8")).hexdigest()
+
+    def _is_excluded(self, path):
+        """Checks if the relative path is one of dazel's own files.
+
+        The temporary files they are written to first are excluded too.
+        """
+        return any(path == excluded or path.startswith(excluded + ".")
+                   for excluded in self.excluded)
+
+    def write_tar(self, fileobj):
+        """Streams the Dockerfile and the context files in use as a tar.
+
+        The Dockerfile is named BUILD_CONTEXT_DOCKERFILE inside the tar. If some
+        sources couldn't be resolved, the whole directory is streamed.
+        """
+        paths = self.files()
+        if self._unresolved:
+            paths = sorted(self._walk(
+                self.directory, DockerIgnore.from_directory(self.directory)))
+        tar = tarfile.open(fileobj=fileobj, mode="w|")
+        tar.add(self.dockerfile, arcname=BUILD_CONTEXT_DOCKERFILE)
+        for path in paths:
+            tar.add(os.path.join(self.directory, path), arcname=path,
+                    recursive=False)
+        tar.close()
+
+    def _walk(self, directory, ignore):
+        """Yields the relative paths of the files under a context directory."""
+        for (root, directories, files) in os.walk(directory):
+            relative_root = os.path.relpath(root, self.directory)
+            if relative_root == ".":
+                relative_root = ""
+            # Prune ignored directories, unless an exception may bring back
+            # some of their contents.
+            if not ignore.has_exceptions:
+                directories[:] = [
+                    d for d in directories
+                    if not ignore.is_ignored(os.path.join(relative_root, d))
+                ]
+            for name in files:
+                path = os.path.join(relative_root, name)
+                if not ignore.is_ignored(path) and not self._is_excluded(path):
+                    yield path
+
+
+def _dockerfile_assignments(keyword, text):
+    """Returns the variables that an ARG or ENV instruction sets.
+
+    Only ARGs with a default value set anything (build arguments given to
+    docker are not known here).
+    """
+    try:
+        words = shlex.split(text)
+    except ValueError:
+        return {}
+    if keyword == "ENV" and words and "=" not in words[0]:
+        # The legacy `ENV NAME value...` form.
+        return {words[0]: " ".join(words[1:])}
+    return dict(word.split("=", 1) for word in words if "=" in word)
+
+
+def _substitute_variables(text, variables):
+    """Replaces the $NAME, ${NAME} and ${NAME:-default} that have values."""
+    def substitute(match):
+        name = match.group(1) or match.group(3)
+        if variables.get(name):
+            return variables[name]
+        if match.group(2) is not None:
+            return match.group(2)
+        return match.group(0)
+    return DOCKERFILE_VARIABLE_REGEX.sub(substitute, text)
+
+
+class DigestCache(object):
+    """A persistent cache of file digests, keyed by (mtime, size, inode).
+
+    Only the entries used since loading are saved back, so the cache never
+    grows beyond the files of a single build context.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, "r") as cache_file:
+                self._entries = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            self._entries = {}
+        self._used = {}
+        self._changed = False
+
+    def digest(self, path):
+        """Returns the digest of the file, hashing it only if it changed."""
+        stat = os.stat(path)
+        key = [stat.st_mtime, stat.st_size, stat.st_ino]
+        entry = self._entries.get(path)
+        if entry and entry[:3] == key:
+            digest = entry[3]
+        else:
+            digest = _file_digest(path)
+            self._changed = True
+        self._used[path] = key + [digest]
+        return digest
+
+    def save(self):
+        if self._changed or len(self._used) != len(self._entries):
+            _write_json_file(self.path, self._used)
+            self._entries = self._used
+            self._changed = False
+
+
+def _file_digest(path):
+    """Returns the sha256 hex digest of the file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SharedCache(object):
+    """A repository cache and disk cache shared by all dazel containers.
+
+    Both caches are content-addressed by bazel itself, so containers of
+    different workspaces can use them concurrently. Commands that use them hold
+    a shared lock on the cache for their whole run, and garbage collection
+    takes the exclusive lock, so that it never deletes entries from under a
+    running build.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.repository_cache = os.path.join(directory, "repository")
+        self.disk_cache = os.path.join(directory, "disk")
+
+    def flags(self, verb):
+        """Returns the flags that point the bazel command at the caches."""
+        flags = []
+        if verb in REPOSITORY_CACHE_COMMANDS:
+            flags += ["--repository_cache=%s" % self.repository_cache]
+        if verb in DISK_CACHE_COMMANDS:
+            flags += ["--disk_cache=%s" % self.disk_cache]
+        return flags
+
+    def lock(self, exclusive=False, timeout=SHARED_CACHE_LOCK_TIMEOUT):
+        """Returns the locked lock file (closing it releases the lock).
+
+        Returns None if the lock could not be taken within the timeout.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        lock_file = open(os.path.join(self.directory, ".lock"), "a")
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(lock_file, operation | fcntl.LOCK_NB)
+                return lock_file
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if time.time() > deadline:
+                lock_file.close()
+                return None
+            time.sleep(0.1)
+
+    def entries(self):
+        """Returns the (mtime, size, path) of every file in the caches.
+
+        Bazel refreshes the mtime of the entries it reads, so this is also when
+        they were last used.
+        """
+        entries = []
+        for cache in [self.repository_cache, self.disk_cache]:
+            for (root, _, files) in os.walk(cache):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.lstat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def stats(self):
+        """Returns the number and size of the entries in each cache."""
+        stats = {}
+        all_entries = self.entries()
+        recent = time.time() - 7 * 24 * 60 * 60
+        for (name, cache) in [("repository", self.repository_cache),
+                              ("disk", self.disk_cache)]:
+            entries = [e for e in all_entries if e[2].startswith(cache + "/")]
+            stats[name] = {
+                "entries": len(entries),
+                "bytes": sum(e[1] for e in entries),
+                "bytes_used_last_7_days": sum(e[1] for e in entries
+                                              if e[0] >= recent),
+            }
+        return stats
+
+    def gc(self, max_size):
+        """Deletes the least recently used entries, down to the given size.
+
+        Returns the number of entries and bytes deleted, or None if the caches
+        were in use for too long.
+        """
+        lock_file = self.lock(exclusive=True)
+        if lock_file is None:
+            return None
+        try:
+            entries = sorted(self.entries())
+            total_size = sum(e[1] for e in entries)
+            deleted_entries, deleted_bytes = 0, 0
+            for (_, size, path) in entries:
+                if total_size - deleted_bytes <= max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                deleted_entries += 1
+                deleted_bytes += size
+                self._remove_empty_parents(os.path.dirname(path))
+            return deleted_entries, deleted_bytes
+        finally:
+            lock_file.close()
+
+    def _remove_empty_parents(self, directory):
+        """Removes the directory and its parents while they are empty."""
+        while directory not in (self.repository_cache, self.disk_cache,
+                                self.directory):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                return
+            directory = os.path.dirname(directory)
+
+
+def _parse_size(size):
+    """Parses a size in bytes, with an optional K, M, G or T suffix.
+
+    The suffix can also be followed by "B" or "iB" (as in docker's output).
+    """
+    size = str(size).strip().upper()
+    for unit in ["IB", "B"]:
+        if size.endswith(unit):
+            size = size[:-len(unit)]
+            break
+    multiplier = 1
+    for (index, suffix) in enumerate("KMGT"):
+        if size.endswith(suffix):
+            size = size[:-1]
+            multiplier = 1024**(index + 1)
+            break
+    return int(float(size) * multiplier)
+
+
+def _host_cpus():
+    """Returns the number of cores of the host."""
+    try:
+        return os.sysconf("SC_NPROCESSORS_ONLN")
+    except (AttributeError, ValueError, OSError):
+        return 1
+
+
+def _host_available_memory():
+    """Returns the memory of the host (in bytes) that isn't in use."""
+    try:
+        with open("/proc/meminfo", "r") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    # Not linux (or too old for MemAvailable), so count the free pages.
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _format_size(size):
+    """Formats a size in bytes for humans."""
+    for suffix in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024:
+            return "%.1f%s" % (size, suffix)
+        size /= 1024.0
+    return "%.1fTiB" % size
+
+
+class BuildReport(object):
+    """The performance of a bazel command, from its build event protocol file.
+
+    The events (one JSON object per line, as --build_event_json_file writes
+    them) are read one at a time, keeping only the totals the report needs, so
+    that the events of large builds are never all in memory at once.
+    """
+
+    def __init__(self):
+        self.start_time = None
+        self.finish_time = None
+        self.exit_code = None
+        self.critical_path = None
+        # The (seconds, description) of the slowest actions so far.
+        self.slowest_actions = []
+        # The seconds of each target, summed over its actions and tests.
+        self.targets = {}
+        # The (actions, seconds between the first start and last end) of each
+        # mnemonic, for when single actions were not published.
+        self.mnemonics = {}
+        self.spawn_cache_hits = 0
+        self.spawns = None
+        self.action_cache = None
+
+    @classmethod
+    def from_file(cls, path):
+        report = cls()
+        with open(path, "r") as events_file:
+            for line in events_file:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # The last event of an interrupted build may be truncated.
+                    continue
+                report.add(event)
+        return report
+
+    def add(self, event):
+        """Adds a build event to the report."""
+        if "started" in event:
+            self.start_time = _parse_event_time(event["started"], "startTime")
+        elif "finished" in event:
+            finished = event["finished"]
+            self.finish_time = _parse_event_time(finished, "finishTime")
+            self.exit_code = int(finished.get("exitCode", {}).get("code", 0))
+        elif "action" in event:
+            self._add_action(event["id"].get("actionCompleted", {}),
+                             event["action"])
+        elif "testResult" in event:
+            result = event["testResult"]
+            seconds = _parse_event_duration(result, "testAttemptDuration")
+            label = event["id"].get("testResult", {}).get("label")
+            if label and seconds is not None:
+                self.targets[label] = self.targets.get(label, 0.0) + seconds
+        elif "buildMetrics" in event:
+            self._add_metrics(event["buildMetrics"])
+        elif "buildToolLogs" in event:
+            for log in event["buildToolLogs"].get("log", []):
+                if log.get("name") != "critical path":
+                    continue
+                contents = base64.b64decode(log.get("contents", "")).decode(
+                    "utf-8", "replace")
+                match = CRITICAL_PATH_REGEX.search(contents)
+                if match:
+                    self.critical_path = float(match.group(1))
+
+    def _add_action(self, action_id, action):
+        start = _parse_event_time(action, "startTime")
+        end = _parse_event_time(action, "endTime")
+        if start is None or end is None:
+            return
+        seconds = end - start
+        label = action.get("label") or action_id.get("label")
+        description = " ".join(
+            part for part in [action.get("type"), label or action_id.get(
+                "primaryOutput")] if part)
+        self.slowest_actions.append((seconds, description))
+        if len(self.slowest_actions) > 2 * BUILD_REPORT_TOP:
+            self.slowest_actions.sort(reverse=True)
+            del self.slowest_actions[BUILD_REPORT_TOP:]
+        if label:
+            self.targets[label] = self.targets.get(label, 0.0) + seconds
+
+    def _add_metrics(self, metrics):
+        summary = metrics.get("actionSummary", {})
+        for data in summary.get("actionData", []):
+            first = int(data.get("firstStartedMs", 0))
+            last = int(data.get("lastEndedMs", 0))
+            self.mnemonics[data.get("mnemonic", "")] = (
+                int(data.get("actionsExecuted", 0)),
+                max(0.0, (last - first) / 1000.0))
+        for runner in summary.get("runnerCount", []):
+            count = int(runner.get("count", 0))
+            if runner.get("name") == "total":
+                self.spawns = (self.spawns or 0) + count
+            elif runner.get("name") == "internal":
+                self.spawns = (self.spawns or 0) - count
+            elif "cache hit" in runner.get("name", ""):
+                self.spawn_cache_hits += count
+        statistics = summary.get("actionCacheStatistics")
+        if statistics is not None:
+            self.action_cache = (int(statistics.get("hits", 0)),
+                                 int(statistics.get("misses", 0)))
+
+    def summary(self):
+        """Returns the report as a dict (None if the build never started).
+
+        Actions count as cache hits when bazel's action cache had them (so
+        they didn't run at all), or when their spawns hit the disk or remote
+        cache.
+        """
+        if self.start_time is None:
+            return None
+        finish_time = self.finish_time
+        if finish_time is None:
+            finish_time = time.time()
+        if self.action_cache is not None:
+            hits = self.action_cache[0] + self.spawn_cache_hits
+            lookups = sum(self.action_cache)
+        else:
+            hits, lookups = self.spawn_cache_hits, self.spawns or 0
+
+        slowest_actions = sorted(self.slowest_actions, reverse=True)
+        if not slowest_actions:
+            slowest_actions = sorted(
+                ((seconds, "%s (%d actions)" % (mnemonic, count))
+                 for (mnemonic, (count, seconds)) in self.mnemonics.items()),
+                reverse=True)
+        slowest_targets = sorted(
+            ((seconds, label) for (label, seconds) in self.targets.items()),
+            reverse=True)
+        return {
+            "exit_code": self.exit_code,
+            "bazel_seconds": max(0.0, finish_time - self.start_time),
+            "critical_path_seconds": self.critical_path,
+            "cache_hits": hits,
+            "cache_lookups": lookups,
+            "cache_hit_ratio": (float(hits) / lookups) if lookups else None,
+            "slowest_actions": [[description, seconds] for (
+                seconds, description) in slowest_actions[:BUILD_REPORT_TOP]],
+            "slowest_targets": [[label, seconds] for (
+                seconds, label) in slowest_targets[:BUILD_REPORT_TOP]],
+        }
+
+
+def _parse_event_time(message, field):
+    """Returns the time of a build event field, in seconds since the epoch.
+
+    Newer bazel versions write timestamps (e.g. "startTime":
+    "2024-01-02T03:04:05.678Z"), older ones milliseconds ("startTimeMillis").
+    """
+    if field + "Millis" in message:
+        return int(message[field + "Millis"]) / 1000.0
+    value = message.get(field)
+    if not value:
+        return None
+    seconds, _, fraction = value.rstrip("Z").partition(".")
+    try:
+        return (calendar.timegm(time.strptime(seconds, "%Y-%m-%dT%H:%M:%S")) +
+                float("0.%s" % (fraction or "0")))
+    except ValueError:
+        return None
+
+
+def _parse_event_duration(message, field):
+    """Returns the seconds of a build event duration (e.g. "1.5s")."""
+    if field + "Millis" in message:
+        return int(message[field + "Millis"]) / 1000.0
+    value = message.get(field)
+    if not value or not value.endswith("s"):
+        return None
+    try:
+        return float(value[:-1])
+    except ValueError:
+        return None
+
+
+def _format_build_report(entry):
+    """Formats a build report for stderr."""
+    lines = ["dazel: build report: %.1fs in total, %.1fs in bazel, %.1fs in "
+             "dazel and docker" % (entry["total_seconds"],
+                                   entry["bazel_seconds"],
+                                   entry["overhead_seconds"])]
+    if entry["critical_path_seconds"] is not None:
+        lines[0] += ", critical path %.1fs" % entry["critical_path_seconds"]
+    if entry["cache_hit_ratio"] is not None:
+        lines[0] += ", cache hits %d/%d (%.1f%%)" % (
+            entry["cache_hits"], entry["cache_lookups"],
+            100.0 * entry["cache_hit_ratio"])
+    for (name, key) in [("actions", "slowest_actions"),
+                        ("targets", "slowest_targets")]:
+        if entry[key]:
+            lines.append("dazel:   slowest %s: %s" % (name, ", ".join(
+                "%s %.1fs" % (description, seconds)
+                for (description, seconds) in entry[key])))
+    return "".join("%s\n" % line for line in lines)
+
+
+class DockerTransportError(Exception):
+    """Raised when a docker transport fails to communicate with the daemon."""
+
+
+class _UnixHTTPConnection(httplib.HTTPConnection):
+    """An HTTP connection to a server listening on a unix domain socket."""
+
+    def __init__(self, socket_path, timeout=DOCKER_API_TIMEOUT):
+        httplib.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class DockerCliTransport(object):
+    """Queries the docker daemon by running the docker command line client.
+
+    This is the fallback transport, used whenever the Engine API cannot be
+    reached directly (docker-machine, TLS-protected daemons, etc).
+    """
+
+    def __init__(self, docker_command, wrap_command=None):
+        self.docker_command = docker_command
+        self.wrap_command = wrap_command or (lambda command: command)
+
+    def inspect_container(self, name):
+        """Returns the inspect dictionary of the given container, or None."""
+        rc, output = self._query("inspect --type container \"%s\"" % name)
+        if rc:
+            return None
+        try:
+            return json.loads(output)[0]
+        except (ValueError, IndexError):
+            return None
+
+    def image_exists(self, image):
+        """Checks if the given image exists in the local repository."""
+        return self._query("image inspect \"%s\"" % image)[0] == 0
+
+    def container_memory(self, name):
+        """Returns the memory used by the running container (None if unknown)."""
+        rc, output = self._query(
+            "stats --no-stream --format \"{{.MemUsage}}\" \"%s\"" % name)
+        try:
+            return _parse_size(output.split("/")[0]) if not rc else None
+        except ValueError:
+            return None
+
+    def inspect_image(self, image):
+        """Returns the inspect dictionary of the given image, or None."""
+        rc, output = self._query("image inspect \"%s\"" % image)
+        if rc:
+            return None
+        try:
+            return json.loads(output)[0]
+        except (ValueError, IndexError):
+            return None
+
+    def network_exists(self, network):
+        """Checks if the given network exists."""
+        return self._query("network inspect \"%s\"" % network)[0] == 0
+
+    def list_containers(self, label):
+        """Returns the names of the running containers with the given label."""
+        rc, output = self._query(
+            "ps --filter \"label=%s\" --format \"{{.Names}}\"" % label)
+        return output.split() if not rc else []
+
+    def list_container_labels(self, label, names):
+        """Returns the given labels of the running containers with the label.
+
+        Each container's labels come as a dictionary of the given names.
+        """
+        rc, output = self._query(
+            "ps --filter \"label=%s\" --format '%s'" % (label, "\t".join(
+                "{{.Label \"%s\"}}" % name for name in names)))
+        if rc:
+            return []
+        return [
+            dict(zip(names, line.split("\t")))
+            for line in output.splitlines() if line.strip()
+        ]
+
+    def volume_sizes(self):
+        """Returns the disk usage of each volume, by name."""
+        rc, output = self._query("system df -v")
+        sizes = {}
+        if rc:
+            return sizes
+        # The volumes are listed under "Local Volumes space usage:", as a
+        # table of their names, links and sizes.
+        lines = iter(output.splitlines())
+        for line in lines:
+            if line.startswith("Local Volumes"):
+                break
+        for line in lines:
+            fields = line.split()
+            if fields[:2] == ["VOLUME", "NAME"]:
+                continue
+            if len(fields) != 3:
+                if sizes:
+                    break
+                continue
+            try:
+                sizes[fields[0]] = _parse_size(fields[2])
+            except ValueError:
+                pass
+        return sizes
+
+    def build(self, tags, dockerfile, write_context):
+        """Builds an image from the build context streamed on stdin."""
+        command = self.wrap_command("%s build %s -f %s -" % (
+            self.docker_command, " ".join("-t %s" % tag for tag in tags),
+            dockerfile))
+        with _span("docker build", "docker", {"tags": tags}):
+            process = subprocess.Popen(command, shell=True,
+                                       stdin=subprocess.PIPE,
+                                       stdout=sys.stderr)
+            try:
+                write_context(process.stdin)
+            except (IOError, OSError) as e:
+                # The build failed early, and its output says why.
+                logger.debug("Could not stream the build context: %s" % e)
+            finally:
+                try:
+                    process.stdin.close()
+                except (IOError, OSError):
+                    pass
+            return process.wait()
+
+    def close(self):
+        pass
+
+    def _query(self, args):
+        """Runs a docker command, returning its exit code and its output."""
+        command = self.wrap_command("%s %s" % (self.docker_command, args))
+        with _span("docker %s" % args.split()[0], "docker",
+                   {"command": command}), open(os.devnull, "w") as devnull:
+            process = subprocess.Popen(command, shell=True,
+                                       stdout=subprocess.PIPE, stderr=devnull)
+            output = process.communicate()[0]
+        return process.returncode, output.decode("utf-8", "replace")
+
+
+class DockerApiTransport(object):
+    """Queries the docker daemon directly through the Docker Engine API.
+
+    A single keep-alive connection is used for all of the requests, over the
+    unix socket or the plain TCP address given in DOCKER_HOST.
+    """
+
+    def __init__(self, docker_host=None, timeout=DOCKER_API_TIMEOUT):
+        self.docker_host = docker_host or os.environ.get(
+            "DOCKER_HOST", DEFAULT_DOCKER_HOST)
+        self.timeout = timeout
+        # http connections can't be shared between threads, so each thread
+        # keeps its own keep-alive connection.
+        self._local = threading.local()
+
+    @classmethod
+    def is_available(cls, docker_host=None):
+        """Checks if the given docker host can be used without a docker client."""
+        if os.environ.get("DOCKER_TLS_VERIFY"):
+            return False
+        url = urlparse(docker_host or
+                       os.environ.get("DOCKER_HOST", DEFAULT_DOCKER_HOST))
+        if url.scheme == "unix":
+            return os.path.exists(url.path)
+        return url.scheme in ("tcp", "http")
+
+    def inspect_container(self, name):
+        """Returns the inspect dictionary of the given container, or None."""
+        return self.get_json("/containers/%s/json" % quote(name, safe=""))
+
+    def image_exists(self, image):
+        """Checks if the given image exists in the local repository."""
+        return self.inspect_image(image) is not None
+
+    def container_memory(self, name):
+        """Returns the memory used by the running container (None if unknown)."""
+        stats = self.get_json("/containers/%s/stats?stream=false" %
+                              quote(name, safe=""))
+        return ((stats or {}).get("memory_stats") or {}).get("usage")
+
+    def inspect_image(self, image):
+        """Returns the inspect dictionary of the given image, or None."""
+        return self.get_json("/images/%s/json" % quote(image, safe=""))
+
+    def network_exists(self, network):
+        """Checks if the given network exists."""
+        return self.get_json("/networks/%s" % quote(network, safe="")) is not None
+
+    def list_containers(self, label):
+        """Returns the names of the running containers with the given label."""
+        return [
+            container["Names"][0].lstrip("/")
+            for container in self._running_containers(label)
+            if container.get("Names")
+        ]
+
+    def list_container_labels(self, label, names):
+        """Returns the given labels of the running containers with the label.
+
+        Each container's labels come as a dictionary of the given names.
+        """
+        return [
+            dict((name, (container.get("Labels") or {}).get(name, ""))
+                 for name in names)
+            for container in self._running_containers(label)
+        ]
+
+    def volume_sizes(self):
+        """Returns the disk usage of each volume, by name."""
+        usage = self.get_json("/system/df") or {}
+        return dict(
+            (volume["Name"], (volume.get("UsageData") or {}).get("Size", -1))
+            for volume in usage.get("Volumes") or []
+            if (volume.get("UsageData") or {}).get("Size", -1) >= 0)
+
+    def _running_containers(self, label):
+        filters = json.dumps({"label": [label]})
+        return self.get_json("/containers/json?%s" %
+                             urlencode([("filters", filters)])) or []
+
+    def build(self, tags, dockerfile, write_context):
+        """Builds an image from the build context streamed to /build."""
+        if sys.version_info < (3, 6):
+            raise DockerTransportError("Streaming builds need Python 3.6+.")
+
+        # The context is written to a pipe by a separate thread, and uploaded
+        # from the other end of the pipe as it is produced.
+        read_fd, write_fd = os.pipe()
+        writer = threading.Thread(target=self._write_context,
+                                  args=(write_fd, write_context))
+        writer.daemon = True
+        writer.start()
+
+        query = urlencode([("t", tag) for tag in tags] +
+                          [("dockerfile", dockerfile), ("rm", "1")])
+        with os.fdopen(read_fd, "rb") as reader:
+            if self._connection is None:
+                self._connection = self._connect()
+            try:
+                self._connection.request(
+                    "POST", "/build?%s" % query,
+                    body=iter(lambda: reader.read(65536), b""),
+                    headers={"Content-Type": "application/x-tar"},
+                    encode_chunked=True)
+                sock = self._connection.sock
+                response = self._connection.getresponse()
+            except (socket.error, httplib.HTTPException) as e:
+                self.close()
+                raise DockerTransportError(
+                    "Could not reach the docker daemon at %s: %s" %
+                    (self.docker_host, e))
+
+        # A build step can run for long without printing anything, so the
+        # output is waited for without a timeout (restored once it's done).
+        sock.settimeout(None)
+        rc = 0
+        try:
+            if response.status >= 300:
+                sys.stderr.write(
+                    response.read().decode("utf-8", "replace") + "\n")
+                rc = 1
+
+            # Relay the build output, which is a stream of JSON messages.
+            for line in iter(response.readline, b""):
+                try:
+                    message = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    continue
+                if message.get("error"):
+                    sys.stderr.write(message["error"] + "\n")
+                    rc = 1
+                elif message.get("stream"):
+                    sys.stderr.write(message["stream"])
+        except (socket.error, httplib.HTTPException) as e:
+            self.close()
+            raise DockerTransportError(
+                "Lost the connection to the docker daemon at %s during the "
+                "build: %s" % (self.docker_host, e))
+        sock.settimeout(self.timeout)
+        return rc
+
+    @staticmethod
+    def _write_context(write_fd, write_context):
+        with os.fdopen(write_fd, "wb") as writer:
+            try:
+                write_context(writer)
+            except (IOError, OSError) as e:
+                logger.debug("Could not stream the build context: %s" % e)
+
+    def get_json(self, path):
+        """Returns the decoded JSON body of a GET request, or None on 404."""
+        status, body = self.request("GET", path)
+        if status == 404:
+            return None
+        if status >= 300:
+            raise DockerTransportError("GET %s failed with status %d: %s" %
+                                       (path, status, body[:200]))
+        return json.loads(body.decode("utf-8"))
+
+    def request(self, method, path, body=None, headers=None):
+        """Sends a request on the keep-alive connection, returning (status, body).
+
+        A request failing on a reused connection is retried once on a fresh one,
+        since the daemon may have closed the idle connection in the meantime.
+        """
+        for attempt in range(2):
+            if self._connection is None:
+                self._connection = self._connect()
+            try:
+                with _span("%s %s" % (method, path.split("?")[0]), "docker"):
+                    self._connection.request(method, path, body, headers or {})
+                    response = self._connection.getresponse()
+                    return response.status, response.read()
+            except (socket.error, httplib.HTTPException) as e:
+                self.close()
+                if attempt:
+                    raise DockerTransportError(
+                        "Could not reach the docker daemon at %s: %s" %
+                        (self.docker_host, e))
+
+    @property
+    def _connection(self):
+        return getattr(self._local, "connection", None)
+
+    @_connection.setter
+    def _connection(self, connection):
+        self._local.connection = connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _connect(self):
+        url = urlparse(self.docker_host)
+        if url.scheme == "unix":
+            return _UnixHTTPConnection(url.path, timeout=self.timeout)
+        if url.scheme in ("tcp", "http"):
+            return httplib.HTTPConnection(url.hostname, url.port or 2375,
+                                          timeout=self.timeout)
+        raise DockerTransportError("Unsupported DOCKER_HOST for the API "
+                                   "transport: %s" % self.docker_host)
+
+
+def _docker_context():
+    """Returns the name of the docker CLI's current context."""
+    if os.environ.get("DOCKER_CONTEXT"):
+        return os.environ["DOCKER_CONTEXT"]
+    config_path = os.path.join(
+        os.environ.get("DOCKER_CONFIG") or os.path.expanduser("~/.docker"),
+        "config.json")
+    try:
+        with open(config_path, "r") as config_file:
+            return json.load(config_file).get("currentContext") or "default"
+    except (IOError, OSError, ValueError):
+        return "default"
+
+
+class StartupScheduler(object):
+    """Runs startup steps concurrently, as soon as their dependencies succeed.
+
+    Each step is a function returning an exit code. Steps whose dependencies
+    failed are skipped, all of the failures are reported together, and the
+    duration of every step is logged.
+    """
+
+    def __init__(self, concurrency=DEFAULT_STARTUP_CONCURRENCY):
+        self.concurrency = max(1, concurrency)
+        self._steps = []
+        self._condition = threading.Condition()
+        self._results = {}
+        self._running = 0
+
+    def add(self, name, function, args=(), dependencies=()):
+        """Adds a step, to run after all of the named dependencies succeed."""
+        self._steps.append((name, function, args, list(dependencies)))
+
+    def steps(self):
+        """Returns the names of the steps added so far."""
+        return [name for (name, _, _, _) in self._steps]
+
+    def run(self):
+        """Runs all of the steps, returning the first failure's exit code."""
+        pending = list(self._steps)
+        start = time.time()
+        with self._condition:
+            while pending or self._running:
+                progressed = False
+                for step in list(pending):
+                    (name, _, _, dependencies) = step
+                    results = [
+                        self._results[d] for d in dependencies
+                        if d in self._results
+                    ]
+                    if any(rc != 0 for rc in results):
+                        # A dependency failed, so this step can't run.
+                        pending.remove(step)
+                        self._results[name] = None
+                        progressed = True
+                    elif (len(results) == len(dependencies) and
+                          self._running < self.concurrency):
+                        pending.remove(step)
+                        self._running += 1
+                        thread = threading.Thread(target=self._run_step,
+                                                  args=step)
+                        thread.daemon = True
+                        thread.start()
+                        progressed = True
+                if progressed:
+                    continue
+                if not self._running:
+                    raise RuntimeError("Unknown startup step dependencies: %s"
+                                       % [step[0] for step in pending])
+                self._condition.wait()
+        logger.info("Startup finished in %.2fs." % (time.time() - start))
+
+        failures = [(name, self._results[name]) for name in self.steps()
+                    if self._results[name]]
+        if failures:
+            logger.error("ERROR: Startup failed in %s" % ", ".join(
+                "'%s' (rc=%d)" % failure for failure in failures))
+            return failures[0][1]
+        return 0
+
+    def _run_step(self, name, function, args, dependencies):
+        start = time.time()
+        try:
+            rc = function(*args) or 0
+        except Exception as e:
+            logger.error("ERROR: Startup step '%s' raised: %s" % (name, e))
+            rc = 1
+        logger.info("Startup step '%s' finished in %.2fs (rc=%d)." %
+                    (name, time.time() - start, rc))
+        with self._condition:
+            self._results[name] = rc
+            self._running -= 1
+            self._condition.notify()
+
+
+class ReadinessProbe(object):
+    """Checks whether a run dependency is ready to serve requests.
+
+    The probe is given as a string, one of:
+        "tcp:PORT" or "tcp:HOST:PORT" - a TCP connection can be opened (to the
+                                        port published on the host, or else
+                                        the container's address on its
+                                        network, unless a host is given).
+        "exec:COMMAND"                - the command succeeds in the container.
+        "health"                      - the container's HEALTHCHECK reports it
+                                        is healthy.
+    """
+
+    KINDS = ("tcp", "exec", "health")
+
+    def __init__(self, instance, spec):
+        self.instance = instance
+        self.spec = spec
+        self.kind, _, self.argument = spec.partition(":")
+
+    @classmethod
+    def validate(cls, spec):
+        kind = spec.partition(":")[0]
+        if kind not in cls.KINDS:
+            raise RuntimeError("Unknown readiness probe '%s' (must start with "
+                               "one of: %s)" % (spec, ", ".join(cls.KINDS)))
+
+    @traced("dazel")
+    def wait(self, deadline):
+        """Polls the probe with exponential backoff until the deadline."""
+        start = time.time()
+        interval = READINESS_INITIAL_INTERVAL
+        attempts = 0
+        while True:
+            attempts += 1
+            if self.check():
+                logger.info("Run dependency '%s' is ready after %.2fs "
+                            "(%d probes)." % (self.instance.instance_name,
+                                              time.time() - start, attempts))
+                return 0
+            if time.time() + interval > deadline:
+                logger.error("ERROR: Run dependency '%s' was not ready after "
+                             "%.2fs (probe: '%s')." %
+                             (self.instance.instance_name,
+                              time.time() - start, self.spec))
+                return 1
+            time.sleep(interval)
+            interval = min(interval * 2, READINESS_MAX_INTERVAL)
+
+    def check(self):
+        """Checks the probe once."""
+        if self.kind == "tcp":
+            return self._check_tcp()
+        if self.kind == "exec":
+            command = "%s exec %s sh -c %s >/dev/null 2>&1" % (
+                self.instance.docker_command, self.instance.instance_name,
+                shell_quote(self.argument))
+            command = self.instance._with_docker_machine(command)
+            return self.instance._run_silent_command(command) == 0
+        info = self.instance._query_docker("inspect_container",
+                                           self.instance.instance_name)
+        health = ((info or {}).get("State") or {}).get("Health") or {}
+        return health.get("Status") == "healthy"
+
+    def _check_tcp(self):
+        host, _, port = self.argument.rpartition(":")
+        port = int(port)
+        if not host:
+            address = self.instance.published_address(port)
+            if address:
+                host, port = address
+            else:
+                host = self.instance.container_address()
+            if not host:
+                return False
+        try:
+            connection = socket.create_connection((host, port), timeout=1)
+        except socket.error:
+            return False
+        connection.close()
+        return True
+
 
 class DockerInstance:
     """Manages communication and runs commands on associated docker container.
@@ -58,11 +1692,35 @@ class DockerInstance:
                  docker_compose_project_name, docker_compose_services,
                  bazel_user_output_root, bazel_rc_file, docker_run_privileged,
                  docker_machine, dazel_run_file, workspace_hex,
-                 delegated_volume):
-        real_directory = os.path.realpath(directory)
+                 delegated_volume, docker_transport=DEFAULT_DOCKER_TRANSPORT,
+                 cache_directory=DEFAULT_CACHE_DIRECTORY,
+                 startup_concurrency=DEFAULT_STARTUP_CONCURRENCY,
+                 startup_lock_timeout=DEFAULT_STARTUP_LOCK_TIMEOUT,
+                 run_deps_readiness=DEFAULT_RUN_DEPS_READINESS,
+                 readiness_timeout=DEFAULT_READINESS_TIMEOUT,
+                 pool_size=DEFAULT_POOL_SIZE, pool_root=DEFAULT_POOL_ROOT,
+                 pool_max_instances=DEFAULT_POOL_MAX_INSTANCES,
+                 bazel_warmup=DEFAULT_BAZEL_WARMUP,
+                 shared_cache_directory=DEFAULT_SHARED_CACHE_DIRECTORY,
+                 shared_cache_max_size=DEFAULT_SHARED_CACHE_MAX_SIZE,
+                 remote_cache=DEFAULT_REMOTE_CACHE,
+                 remote_cache_image=DEFAULT_REMOTE_CACHE_IMAGE,
+                 remote_cache_directory=DEFAULT_REMOTE_CACHE_DIRECTORY,
+                 remote_cache_max_size=DEFAULT_REMOTE_CACHE_MAX_SIZE,
+                 remote_cache_url=DEFAULT_REMOTE_CACHE_URL,
+                 mount_modes=DEFAULT_MOUNT_MODES,
+                 image_pin_ttl=DEFAULT_IMAGE_PIN_TTL,
+                 resources=DEFAULT_RESOURCES,
+                 shard_hosts=DEFAULT_SHARD_HOSTS,
+                 gc_idle_timeout=DEFAULT_GC_IDLE_TIMEOUT,
+                 gc_max_size=DEFAULT_GC_MAX_SIZE,
+                 gc_interval=DEFAULT_GC_INTERVAL,
+                 build_report=DEFAULT_BUILD_REPORT):
         self.workspace_hex_digest = ""
         self.instance_name = instance_name
+        self.base_instance_name = instance_name
         self.image_name = image_name
+        self.base_image_name = image_name
         self.run_command = run_command
         self.docker_command = docker_command
         self.docker_exec_command = docker_exec_command
@@ -81,8 +1739,37 @@ class DockerInstance:
         self.docker_machine = docker_machine
         self.dazel_run_file = dazel_run_file
         self.delegated_volume_flag = ":delegated" if delegated_volume else ""
+        self.docker_transport = docker_transport
+        self.cache_directory = _normalize_cache_directory(cache_directory)
+        self.startup_concurrency = int(startup_concurrency)
+        self.startup_lock_timeout = float(startup_lock_timeout)
+        self.readiness_timeout = float(readiness_timeout)
+        self.pool_size = int(pool_size)
+        self.pool_root = pool_root
+        self.pool_max_instances = int(pool_max_instances)
+        self.bazel_warmup = bazel_warmup
+        self.shared_cache_directory = (
+            os.path.realpath(os.path.expanduser(shared_cache_directory))
+            if shared_cache_directory else "")
+        self.shared_cache_max_size = _parse_size(shared_cache_max_size)
+        self.remote_cache = remote_cache
+        self.remote_cache_image = remote_cache_image
+        self.remote_cache_directory = os.path.realpath(os.path.expanduser(
+            remote_cache_directory or
+            os.path.join(self.cache_directory, "remote-cache")))
+        self.remote_cache_max_size = int(remote_cache_max_size)
+        self.remote_cache_url = remote_cache_url
+        self.image_pin_ttl = float(image_pin_ttl)
+        self.gc_idle_timeout = float(gc_idle_timeout)
+        self.gc_max_size = _parse_size(gc_max_size) if gc_max_size else None
+        self.gc_interval = float(gc_interval)
+        self.build_report = build_report
+        self.build_events_directory = os.path.join(
+            os.path.realpath(self.cache_directory), "build-events")
+        self._reset_runtime_state()
 
         if workspace_hex:
+            real_directory = os.path.realpath(directory)
             self.workspace_hex_digest = hashlib.md5(
                 real_directory.encode("ascii")).hexdigest()
             self.instance_name = "%s_%s" % (self.instance_name,
@@ -97,11 +1784,30 @@ class DockerInstance:
             self.network = "%s_%s" % (self.docker_compose_project_name,
                                       network)
 
+        self._add_mount_modes(mount_modes)
+        self._add_resources(resources)
+        self._add_shard_hosts(shard_hosts)
         self._add_volumes(volumes)
         self._add_ports(ports)
         self._add_run_deps(run_deps)
+        self._add_run_deps_readiness(run_deps_readiness)
         self._add_compose_services(docker_compose_services)
 
+    def _reset_runtime_state(self):
+        """Resets the state that is created lazily, and never cached."""
+        self._transport = None
+        self.reset_image_state()
+
+    def reset_image_state(self):
+        """Forgets the image's content digest and pin, to be read again.
+
+        Long-lived instances (in the dazel server) call this before each
+        command, since other dazel processes may have rebuilt or pulled the
+        image in the meantime.
+        """
+        self._build_context = None
+        self._image_pin = None
+
     @classmethod
     def get_dockerfile(cls, dockerfile_name):
         if dockerfile_name.startswith('/'):
@@ -109,9 +1815,90 @@ class DockerInstance:
         return os.path.join(cls._find_workspace_directory(), dockerfile_name)
 
     @classmethod
+    @traced("dazel")
     def from_config(cls):
+        """Creates the instance from .dazelrc and the environment.
+
+        The resolved instance is cached in the workspace, keyed by the .dazelrc
+        file, the DAZEL_* environment and dazel itself, so that most commands
+        neither execute the .dazelrc nor probe the filesystem again. Setting
+        DAZEL_CONFIG_CACHE=0 in the environment disables this.
+        """
+        if os.environ.get("DAZEL_CONFIG_CACHE", "1").lower() in ("0", "false"):
+            return cls._resolve_config()
+
+        workspace_directory = cls._find_workspace_directory()
+        cache_path = os.path.join(workspace_directory, DAZEL_CONFIG_CACHE_FILE)
+        key = cls._config_cache_key(workspace_directory)
+        instance = cls._load_cached_config(cache_path, key)
+        if instance is None:
+            instance = cls._resolve_config()
+            instance._save_cached_config(cache_path, key)
+        return instance
+
+    @classmethod
+    def _config_cache_key(cls, workspace_directory):
+        """Returns the key of the cached configuration."""
+        dazel_stat = os.stat(os.path.abspath(__file__))
+        return [
+            DAZEL_CONFIG_CACHE_VERSION,
+            _config_fingerprint(workspace_directory), workspace_directory,
+            os.environ.get("USER", ""), [dazel_stat.st_mtime, dazel_stat.st_size]
+        ]
+
+    @classmethod
+    def _load_cached_config(cls, cache_path, key):
+        """Returns the cached instance if its key matches, or None."""
+        try:
+            with open(cache_path, "r") as cache_file:
+                cached = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(cached, dict) or cached.get("key") != key:
+            return None
+        # The resolution depends on where these paths lead.
+        for (path, real_path) in cached.get("paths", {}).items():
+            if cls._resolved_path(path) != real_path:
+                return None
+
+        instance = cls.__new__(cls)
+        instance.__dict__.update(cached["attributes"])
+        instance._reset_runtime_state()
+        return instance
+
+    def _save_cached_config(self, cache_path, key):
+        """Caches the resolved instance under the given key."""
+        attributes = {
+            name: value
+            for (name, value) in self.__dict__.items()
+            if not name.startswith("_")
+        }
+        paths = {
+            path: self._resolved_path(path)
+            for path in [self.dockerfile,
+                         os.path.join(self.directory, "bazel-out")] if path
+        }
+        try:
+            _write_json_file(cache_path, {
+                "key": key,
+                "paths": paths,
+                "attributes": attributes
+            })
+        except (IOError, OSError, TypeError, ValueError) as e:
+            # The .dazelrc may hold values that can't be cached.
+            logger.debug("Could not cache the configuration: %s" % e)
+
+    @staticmethod
+    def _resolved_path(path):
+        """Returns the real path of the path, or None if it doesn't exist."""
+        return os.path.realpath(path) if os.path.exists(path) else None
+
+    @classmethod
+    def _resolve_config(cls, overrides=None):
+        """Creates the instance by reading and resolving the configuration."""
         config = cls._config_from_file()
         config.update(cls._config_from_environment())
+        config.update(overrides or {})
         return DockerInstance(
             instance_name=config.get("DAZEL_INSTANCE_NAME",
                                      DEFAULT_INSTANCE_NAME),
@@ -149,139 +1936,1131 @@ class DockerInstance:
                                              DEFAULT_DOCKER_RUN_PRIVILEGED),
             docker_machine=config.get("DAZEL_DOCKER_MACHINE",
                                       DEFAULT_DOCKER_MACHINE),
-            dazel_run_file=config.get("DAZEL_RUN_FILE", DAZEL_RUN_FILE),
+            dazel_run_file=os.path.join(
+                cls._find_workspace_directory(),
+                config.get("DAZEL_RUN_FILE", DAZEL_RUN_FILE)),
             workspace_hex=config.get("DAZEL_WORKSPACE_HEX",
                                      DEFAULT_WORKSPACE_HEX),
             delegated_volume=config.get("DAZEL_DELEGATED_VOLUME",
-                                        "DEFAULT_DELEGATED_VOLUME"), )
+                                        DEFAULT_DELEGATED_VOLUME),
+            docker_transport=config.get("DAZEL_DOCKER_TRANSPORT",
+                                        DEFAULT_DOCKER_TRANSPORT),
+            cache_directory=config.get("DAZEL_CACHE_DIRECTORY",
+                                       DEFAULT_CACHE_DIRECTORY),
+            startup_concurrency=config.get("DAZEL_STARTUP_CONCURRENCY",
+                                           DEFAULT_STARTUP_CONCURRENCY),
+            startup_lock_timeout=config.get("DAZEL_STARTUP_LOCK_TIMEOUT",
+                                            DEFAULT_STARTUP_LOCK_TIMEOUT),
+            run_deps_readiness=config.get("DAZEL_RUN_DEPS_READINESS",
+                                          DEFAULT_RUN_DEPS_READINESS),
+            readiness_timeout=config.get("DAZEL_READINESS_TIMEOUT",
+                                         DEFAULT_READINESS_TIMEOUT),
+            pool_size=config.get("DAZEL_POOL_SIZE", DEFAULT_POOL_SIZE),
+            pool_root=config.get("DAZEL_POOL_ROOT", DEFAULT_POOL_ROOT),
+            pool_max_instances=config.get("DAZEL_POOL_MAX_INSTANCES",
+                                          DEFAULT_POOL_MAX_INSTANCES),
+            bazel_warmup=config.get("DAZEL_BAZEL_WARMUP",
+                                    DEFAULT_BAZEL_WARMUP),
+            shared_cache_directory=config.get("DAZEL_SHARED_CACHE_DIRECTORY",
+                                              DEFAULT_SHARED_CACHE_DIRECTORY),
+            shared_cache_max_size=config.get("DAZEL_SHARED_CACHE_MAX_SIZE",
+                                             DEFAULT_SHARED_CACHE_MAX_SIZE),
+            remote_cache=config.get("DAZEL_REMOTE_CACHE",
+                                    DEFAULT_REMOTE_CACHE),
+            remote_cache_image=config.get("DAZEL_REMOTE_CACHE_IMAGE",
+                                          DEFAULT_REMOTE_CACHE_IMAGE),
+            remote_cache_directory=config.get("DAZEL_REMOTE_CACHE_DIRECTORY",
+                                              DEFAULT_REMOTE_CACHE_DIRECTORY),
+            remote_cache_max_size=config.get("DAZEL_REMOTE_CACHE_MAX_SIZE",
+                                             DEFAULT_REMOTE_CACHE_MAX_SIZE),
+            remote_cache_url=config.get("DAZEL_REMOTE_CACHE_URL",
+                                        DEFAULT_REMOTE_CACHE_URL),
+            mount_modes=config.get("DAZEL_MOUNT_MODES", DEFAULT_MOUNT_MODES),
+            image_pin_ttl=config.get("DAZEL_IMAGE_PIN_TTL",
+                                     DEFAULT_IMAGE_PIN_TTL),
+            resources=config.get("DAZEL_RESOURCES", DEFAULT_RESOURCES),
+            shard_hosts=config.get("DAZEL_SHARD_HOSTS", DEFAULT_SHARD_HOSTS),
+            gc_idle_timeout=config.get("DAZEL_GC_IDLE_TIMEOUT",
+                                       DEFAULT_GC_IDLE_TIMEOUT),
+            gc_max_size=config.get("DAZEL_GC_MAX_SIZE", DEFAULT_GC_MAX_SIZE),
+            gc_interval=config.get("DAZEL_GC_INTERVAL", DEFAULT_GC_INTERVAL),
+            build_report=config.get("DAZEL_BUILD_REPORT",
+                                    DEFAULT_BUILD_REPORT), )
 
+    @traced("command")
     def send_command(self, args):
-        command = "%s exec -i -e TERM=%s %s %s %s %s %s %s %s" % (
-            self.docker_exec_command, os.environ.get("TERM", ""), "-t"
-            if sys.stdout.isatty() else "", "--privileged"
-            if self.docker_run_privileged else "", self.instance_name,
-            self.command, ("--bazelrc=%s" % self.bazel_rc_file
-                           if self.bazel_rc_file and self.command else ""),
-            ("--output_user_root=%s --output_base=%s" %
-             (TEMP_BAZEL_OUTPUT_USER_ROOT, self.bazel_output_base)
-             if self.command and self.bazel_output_base else
-             "--output_user_root=%s" % self.bazel_user_output_root
-             if self.command and self.bazel_user_output_root else ""),
-            '"%s"' % '" "'.join(args))
-        command = self._with_docker_machine(command)
-        return os.WEXITSTATUS(os.system(command))
+        """Runs the arguments in the container, returning their exit status.
+
+        The docker client inherits our stdin, stdout and stderr, so the output
+        goes straight to them without passing through dazel. Since docker exec
+        does not proxy signals, SIGTERM (and SIGINT, unless the terminal sends
+        it through the tty) is relayed to the process in the container, which
+        writes its pid to a file for that. Signal handlers can only be set from
+        the main thread, so commands run from other threads are not wrapped.
+
+        With DAZEL_BUILD_REPORT, bazel also writes its build events to the
+        host, which dazel reports on once the command is done.
+        """
+        tty = sys.stdout.isatty()
+        pid_file = "%s%s.pid" % (PID_FILE_PREFIX, binascii.hexlify(
+            os.urandom(8)).decode("ascii"))
+        lock_file = self.lock_shared_cache(args)
+        metrics_url = self._remote_cache_metrics_url(args)
+        counters = _remote_cache_counters(metrics_url)
+        build_events_file = self._build_events_file(args)
+
+        relayed_signals = [signal.SIGTERM] + ([] if tty else [signal.SIGINT])
+        handlers = {}
+
+        def relay(signum, frame):
+            self._kill_in_container(pid_file, signum)
+
+        try:
+            for signum in relayed_signals:
+                handlers[signum] = signal.signal(signum, relay)
+        except ValueError:
+            # Signal handlers can only be set from the main thread.
+            pass
+        try:
+            process = subprocess.Popen(self.exec_command(
+                self._with_build_events_flags(args, build_events_file),
+                tty=tty, pid_file=pid_file if handlers else None,
+                clean_pid_files=bool(handlers) and self._pid_files_due()))
+            rc = process.wait()
+        finally:
+            for (signum, handler) in handlers.items():
+                signal.signal(signum, handler)
+            if lock_file:
+                lock_file.close()
+
+        if counters is not None:
+            _report_remote_cache_hits(counters,
+                                      _remote_cache_counters(metrics_url))
+        if build_events_file:
+            self._report_build(args, build_events_file)
+
+        # Report a docker client killed by a signal like the shell would.
+        return 128 - rc if rc < 0 else rc
+
+    def _build_events_file(self, args):
+        """Returns the file to write the command's build events to, if any."""
+        if (not self.build_report or not self.command or
+                self._command_verb(args) not in BUILD_REPORT_COMMANDS):
+            return None
+        return os.path.join(self.build_events_directory, "%s.json" %
+                            binascii.hexlify(os.urandom(8)).decode("ascii"))
+
+    def _with_build_events_flags(self, args, build_events_file):
+        """Returns the arguments with the flags that write the build events.
+
+        All actions are published (not only the failed ones), so that the
+        report can name the slowest actions and targets.
+        """
+        args = list(args)
+        if not build_events_file:
+            return args
+        index = args.index(self._command_verb(args)) + 1
+        return args[:index] + [
+            "--build_event_json_file=%s" % build_events_file,
+            "--build_event_publish_all_actions",
+        ] + args[index:]
+
+    def _report_build(self, args, build_events_file):
+        """Reports the performance of the command from its build events.
+
+        The compact report goes to stderr, and is added to the build history in
+        the cache directory (which `dazel report` reads).
+        """
+        try:
+            report = BuildReport.from_file(build_events_file)
+        except (IOError, OSError):
+            # Bazel exited before writing any events (e.g. on bad flags).
+            return
+        finally:
+            try:
+                os.remove(build_events_file)
+            except OSError:
+                pass
+        entry = report.summary()
+        if entry is None:
+            return
+        entry["total_seconds"] = time.time() - _start_time
+        entry["overhead_seconds"] = max(
+            0.0, entry["total_seconds"] - entry["bazel_seconds"])
+        entry.update({
+            "time": time.time(),
+            "directory": os.path.realpath(self.directory),
+            "args": list(args),
+        })
+        sys.stderr.write(_format_build_report(entry))
+        history_path = os.path.join(self.cache_directory, BUILD_HISTORY_FILE)
+        try:
+            # A single append of a line, so concurrent builds don't interleave.
+            with open(history_path, "a") as history_file:
+                history_file.write("%s\n" % json.dumps(entry, sort_keys=True))
+        except (IOError, OSError) as e:
+            logger.warning("Could not write the build history: %s" % e)
+
+    def exec_command(self, args, tty, term=None, pid_file=None,
+                     clean_pid_files=False):
+        """Returns the argv that runs the arguments in the container.
+
+        Given a pid file, the process in the container writes its pid to it.
+        Since the process is replaced by the command, it can't remove the file
+        when it's done: with clean_pid_files, the pid files of commands that
+        are gone are removed first (if older than a minute, so that files still
+        being written are left alone).
+        """
+        command = self.exec_prefix(tty, term)
+        if pid_file:
+            script = 'echo $$ > %s && exec "$@"' % pid_file
+            if clean_pid_files:
+                script = (
+                    'for f in $(find %s -maxdepth 1 -name "%s*.pid" -mmin +1 '
+                    '2>/dev/null); do kill -0 "$(cat "$f")" 2>/dev/null || '
+                    'rm -f "$f"; done; %s') % (
+                        os.path.dirname(PID_FILE_PREFIX),
+                        os.path.basename(PID_FILE_PREFIX), script)
+            command += ["/bin/sh", "-c", script, "dazel"]
+        return self.wrap_argv(command + self.bazel_argv(args))
+
+    def _pid_files_due(self):
+        """Checks if the stale pid files in the container are due for removal.
+
+        This is at most every PID_FILE_CLEANUP_INTERVAL seconds, as recorded by
+        the modification time of a stamp file next to the instance record.
+        """
+        stamp_file = os.path.splitext(self._instance_record_file())[0] + ".pids"
+        try:
+            if time.time() - os.path.getmtime(stamp_file) < \
+                    PID_FILE_CLEANUP_INTERVAL:
+                return False
+        except OSError:
+            pass
+        try:
+            with open(stamp_file, "a"):
+                pass
+            os.utime(stamp_file, None)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def exec_prefix(self, tty, term=None):
+        """Returns the docker exec argv, up to the command in the container."""
+        command = shlex.split(self.docker_exec_command) + [
+            "exec", "-i", "-e",
+            "TERM=%s" % (os.environ.get("TERM", "") if term is None else term)
+        ]
+        if tty:
+            command += ["-t"]
+        if self.docker_run_privileged:
+            command += ["--privileged"]
+        return command + self._exec_workdir_args() + [self.instance_name]
+
+    def bazel_argv(self, args):
+        """Returns the argv of the bazel command in the container."""
+        return (shlex.split(self.command or "") + self._bazel_startup_args() +
+                self._with_command_flags(args))
+
+    def wrap_argv(self, command):
+        """Returns the argv that runs the docker command on the host."""
+        if self.docker_machine is None:
+            return command
+        return ["/bin/sh", "-c", self._with_docker_machine(
+            "exec %s" % " ".join(shell_quote(arg) for arg in command))]
+
+    @property
+    def shared_cache(self):
+        """Returns the cache shared by all containers, if there is one."""
+        if not self.shared_cache_directory:
+            return None
+        return SharedCache(self.shared_cache_directory)
+
+    def lock_shared_cache(self, args):
+        """Locks the shared cache for a command that uses it.
+
+        Returns the lock file (closing it releases the lock), or None.
+        """
+        verb = self._command_verb(args)
+        if not (self.command and self.shared_cache and
+                self.shared_cache.flags(verb)):
+            return None
+        return self.shared_cache.lock()
+
+    def _with_command_flags(self, args):
+        """Returns the arguments with our flags for the command after its verb."""
+        args = list(args)
+        verb = self._command_verb(args)
+        if not self.command or verb is None:
+            return args
+        index = args.index(verb) + 1
+        return args[:index] + self._command_flags(verb) + args[index:]
+
+    def _command_flags(self, verb):
+        """Returns the flags that dazel adds to the given bazel command."""
+        flags = []
+        if self.shared_cache:
+            flags += self.shared_cache.flags(verb)
+        if self.remote_cache_enabled() and verb in DISK_CACHE_COMMANDS:
+            flags += ["--remote_cache=%s" % (
+                self.remote_cache_url or "grpc://%s:%d" %
+                (self._remote_cache_name(), REMOTE_CACHE_GRPC_PORT))]
+        if self.resources and verb in DISK_CACHE_COMMANDS:
+            flags += self._resource_flags()
+        return flags
+
+    def _resource_flags(self):
+        """Returns the bazel flags that match the container's limits.
+
+        The limits are the ones the container was actually started with (as
+        recorded in the dazel run file), since automatically sized ones depend
+        on the load of the host at the time.
+        """
+        limits = (self.load_state() or {}).get("resources") or {}
+        flags = []
+        if limits.get("cpus"):
+            flags += ["--local_cpu_resources=%g" % limits["cpus"],
+                      "--jobs=%d" % max(1, int(round(limits["cpus"])))]
+        if limits.get("memory"):
+            flags += ["--local_ram_resources=%d" % (
+                limits["memory"] * BAZEL_RAM_RESOURCES_FRACTION / 1024**2)]
+        return flags
+
+    def remote_cache_enabled(self):
+        """Checks if commands use a remote cache (managed or not)."""
+        return bool(self.remote_cache or self.remote_cache_url)
+
+    def _remote_cache_name(self):
+        """Returns the name of the remote cache container on our network.
+
+        It is shared by all of the workspaces on the same network.
+        """
+        return "%s_remote_cache" % self.network
+
+    def _remote_cache_instance(self):
+        """Creates the DockerInstance of the managed remote cache."""
+        instance = self._run_dep_instance(self.remote_cache_image,
+                                          self._remote_cache_name())
+        instance.volumes = '-v "%s:/data"' % self.remote_cache_directory
+        instance.run_command = "--max_size=%d --enable_endpoint_metrics" % (
+            self.remote_cache_max_size)
+        # Probed and scraped from the host, on ports that docker picks.
+        instance._add_ports(["127.0.0.1::%d" % REMOTE_CACHE_GRPC_PORT,
+                             "127.0.0.1::%d" % REMOTE_CACHE_HTTP_PORT])
+        return instance
+
+    @traced("dazel")
+    def _start_remote_cache(self, deadline):
+        """Starts the managed remote cache, and waits for it to be ready."""
+        instance = self._remote_cache_instance()
+        if not instance.is_running():
+            if not os.path.isdir(self.remote_cache_directory):
+                os.makedirs(self.remote_cache_directory)
+            logger.info("Starting the remote cache: '%s'" %
+                        instance.instance_name)
+            rc = instance._run_container()
+            if rc:
+                return rc
+        return ReadinessProbe(instance, "tcp:%d" %
+                              REMOTE_CACHE_GRPC_PORT).wait(deadline)
+
+    def _remote_cache_metrics_url(self, args):
+        """Returns where to read the remote cache counters for the command.
+
+        The managed remote cache is reached on the port it publishes on the
+        host (recorded in the dazel run file), and HTTP caches given by URL on
+        their host.
+        """
+        if (not self.remote_cache_enabled() or
+                self._command_verb(args) not in DISK_CACHE_COMMANDS):
+            return None
+        if self.remote_cache_url:
+            url = urlparse(self.remote_cache_url)
+            if url.scheme not in ("http", "https"):
+                return None
+            return "%s://%s/metrics" % (url.scheme, url.netloc)
+        return (self.load_state() or {}).get("remote_cache_metrics_url")
+
+    @staticmethod
+    def _command_verb(args):
+        """Returns the bazel command (build, test...) of the arguments."""
+        for arg in args:
+            if not arg.startswith("-"):
+                return arg
+        return None
+
+    def _kill_in_container(self, pid_file, signum):
+        """Sends the signal to the process that wrote the pid file."""
+        command = "%s exec %s /bin/sh -c 'kill -%d $(cat %s) 2>/dev/null'" % (
+            self.docker_exec_command, self.instance_name, signum, pid_file)
+        self._run_silent_command(self._with_docker_machine(command))
+
+    def _exec_workdir_args(self):
+        """Returns the docker exec arguments that set the working directory."""
+        # Pool containers are started in the pool root, not in our workspace.
+        if self.pool_enabled():
+            return ["-w", os.path.realpath(self.directory)]
+        return []
+
+    def _bazel_startup_args(self):
+        """Returns the bazel startup options that every command runs with."""
+        if not self.command:
+            return []
+        startup_args = []
+        if self.bazel_rc_file:
+            startup_args += ["--bazelrc=%s" % self.bazel_rc_file]
+        if self.bazel_output_base:
+            startup_args += [
+                "--output_user_root=%s" % TEMP_BAZEL_OUTPUT_USER_ROOT,
+                "--output_base=%s" % self.bazel_output_base
+            ]
+        elif self.bazel_user_output_root:
+            startup_args += [
+                "--output_user_root=%s" % self.bazel_user_output_root
+            ]
+        return startup_args
 
+    @traced("dazel")
     def start(self):
-        """Starts the dazel docker container."""
-        rc = 0
+        """Starts the dazel docker container, unless another dazel just did.
+
+        Concurrent dazel processes of the same container take turns through the
+        startup lock, so only the first one (re)starts the container, and the
+        others wait for it and then reuse the container.
+        """
+        lock_file = self._lock_startup()
+        if lock_file is None:
+            logger.error("ERROR: Timed out waiting for another dazel process "
+                         "to start '%s'." % self.instance_name)
+            return 1
+        try:
+            # Check again now that we hold the lock.
+            if self.is_state_fresh(self.load_state()) and self.is_running():
+                logger.info("Container '%s' was started by another dazel "
+                            "process." % self.instance_name)
+                return 0
+            rc = self._start()
+        finally:
+            lock_file.close()
+        if not rc:
+            self._schedule_gc()
+        return rc
+
+    def _schedule_gc(self):
+        """Runs `dazel gc` in the background, every DAZEL_GC_INTERVAL seconds.
+
+        Starting a container is what adds to the load of the host, so this is
+        when we check if the idle containers need reaping.
+        """
+        if self.gc_interval <= 0:
+            return
+        stamp_path = os.path.join(self.cache_directory, "gc.stamp")
+        try:
+            if time.time() - os.path.getmtime(stamp_path) < self.gc_interval:
+                return
+        except OSError:
+            pass
+        open(stamp_path, "a").close()
+        os.utime(stamp_path, None)
+        _spawn_detached(["--gc"], os.path.join(self.cache_directory, "gc.log"))
 
+    def _lock_startup(self):
+        """Returns the locked startup lock file (closing it releases the lock).
+
+        Returns None if the lock could not be taken within the timeout. The lock
+        is released by the kernel when its holder exits (the file is not
+        inherited by the processes we start), so it can't go stale.
+        """
+        path = os.path.join(self.cache_directory, "instances",
+                            "%s.lock" % self.instance_name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        deadline = time.time() + self.startup_lock_timeout
+        while True:
+            lock_file = open(path, "a")
+            fcntl.fcntl(lock_file, fcntl.F_SETFD,
+                        fcntl.fcntl(lock_file, fcntl.F_GETFD) |
+                        fcntl.FD_CLOEXEC)
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # `dazel gc` removes the lock file of the containers it removes
+                # (while holding it), so make sure we locked the current one.
+                if _same_file(lock_file, path):
+                    return lock_file
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            lock_file.close()
+            if time.time() > deadline:
+                return None
+            time.sleep(0.1)
+
+    def _start(self):
+        """Starts the dazel docker container.
+
+        The independent startup steps (acquiring the image, creating the
+        network and starting each of the run dependencies) run concurrently,
+        and the container itself is started once all of them succeed. We only
+        return once the run dependencies with readiness probes are ready.
+        """
         # Verify that the docker executable exists.
         if not self._docker_exists():
             logger.error("ERROR: Docker executable could not be found!")
             return 1
 
+        # The cached configuration skips creating these.
+        self._make_output_directories()
+
+        scheduler = StartupScheduler(self.startup_concurrency)
+
         # Build or pull the relevant dazel image.
-        if os.path.exists(self.dockerfile):
-            rc = self._build()
-        else:
-            rc = self._pull()
-            # If we have the image, don't stop everything just because we
-            # couldn't pull.
-            if rc and self._image_exists():
-                rc = 0
-        if rc:
-            return rc
+        scheduler.add("image", self._acquire_image)
 
         # If given a docker-compose file, start the services needed to run.
         if self.docker_compose_file and self._docker_compose_exists():
-            rc = self._start_compose_services()
+            scheduler.add("compose", self._start_compose_services)
         else:
             # If not through docker-compose, run the various dependencies as
-            # necessary ourselves.
+            # necessary ourselves, once the network is set up.
+            scheduler.add("network", self._ensure_network)
+            for (run_dep_image, run_dep_name) in self.run_deps:
+                scheduler.add("run_dep:%s" % run_dep_name,
+                              self._start_run_dep,
+                              args=(run_dep_image, run_dep_name),
+                              dependencies=["network"])
 
-            # Setup the network if necessary.
-            if not self._network_exists():
-                logger.info("Creating network: '%s'" % self.network)
-                rc = self._start_network()
-            if rc:
-                return rc
+        # Start the managed remote cache once its network exists (the
+        # container only needs it when running commands, so wait for it to
+        # be ready alongside the container).
+        deadline = time.time() + self.readiness_timeout
+        if self.remote_cache and not self.remote_cache_url:
+            scheduler.add("remote_cache", self._start_remote_cache,
+                          args=(deadline,), dependencies=[
+                              "compose" if "compose" in scheduler.steps()
+                              else "network"])
+
+        # Run the container itself.
+        scheduler.add("container", self._start_container,
+                      dependencies=[step for step in scheduler.steps()
+                                    if step != "remote_cache"])
+
+        # Start the bazel server ahead of the first command, if requested.
+        if self.bazel_warmup and self.command:
+            scheduler.add("warmup", self._warm_up_bazel,
+                          dependencies=["container"])
+
+        # Wait for the run dependencies to be ready (alongside the container
+        # startup), within a single overall deadline.
+        for (run_dep_image, run_dep_name) in self.run_deps:
+            probe = self._readiness_probe(run_dep_image, run_dep_name)
+            if probe and "run_dep:%s" % run_dep_name in scheduler.steps():
+                scheduler.add("ready:%s" % run_dep_name, probe.wait,
+                              args=(deadline,),
+                              dependencies=["run_dep:%s" % run_dep_name])
+        return scheduler.run()
+
+    def _warm_up_bazel(self):
+        """Starts the bazel server in the container, in the background.
 
-            # Setup run dependencies if necessary.
-            rc = self._start_run_deps()
+        We run `bazel info` with the same startup options as the commands we
+        forward, so that they reuse the server instead of starting their own.
+        """
+        logger.info("Warming up the bazel server...")
+        command = "%s exec -d %s %s %s %s %s info" % (
+            self.docker_exec_command, "--privileged"
+            if self.docker_run_privileged else "",
+            " ".join(self._exec_workdir_args()), self.instance_name,
+            self.command, " ".join(self._bazel_startup_args()))
+        rc = self._run_silent_command(self._with_docker_machine(command))
         if rc:
+            # The first command starts the bazel server anyway.
+            logger.warning("WARNING: Could not warm up the bazel server.")
+        return 0
+
+    def _readiness_probe(self, run_dep_image, run_dep_name):
+        """Returns the readiness probe of the run dependency, if it has one."""
+        spec = self.run_deps_readiness.get(
+            run_dep_name, self.run_deps_readiness.get(run_dep_image))
+        if not spec:
+            return None
+        return ReadinessProbe(
+            self._run_dep_instance(run_dep_image, run_dep_name), spec)
+
+    @traced("dazel")
+    def _start_container(self):
+        """Claims a warm container from the pool, or runs a new one."""
+        if not self.pool_enabled():
+            return self._run_container()
+
+        if self._claim_pool_container():
+            self.save_state()
+            rc = 0
+        else:
+            rc = self._run_container()
+
+        # Top the pool back up in the background.
+        if not rc:
+            _spawn_detached(["--fill-pool"])
+        return rc
+
+    def pool_enabled(self):
+        """Checks if the workspace uses the warm container pool.
+
+        Pool containers are started before we know which workspace will claim
+        them, so they mount the whole pool root (which must contain the
+        workspace) and the whole bazel user output root. This only applies to
+        workspace_hex mode, where each workspace has its own container.
+        """
+        if (self.pool_size <= 0 or not self.pool_root or self.mount_modes or
+                not self.workspace_hex_digest or
+                not self.bazel_user_output_root or self.ports):
+            return False
+        real_pool_root = os.path.realpath(self.pool_root)
+        return os.path.realpath(self.directory).startswith(real_pool_root +
+                                                           os.sep)
+
+    def fill_pool(self):
+        """Tops up the pool of warm containers, and evicts idle claimed ones.
+
+        Claimed containers beyond DAZEL_POOL_MAX_INSTANCES are removed, least
+        recently used first, unless they are being started (as `dazel gc`
+        does, their startup lock is taken while they are removed).
+        """
+        if not self.pool_enabled():
+            return 0
+
+        containers = self._query_docker("list_containers", "%s=%s" %
+                                        (POOL_LABEL, self._pool_fingerprint()))
+        pool_prefix = "%s_pool_" % self.base_instance_name
+        idle = [name for name in containers if name.startswith(pool_prefix)]
+        claimed = [name for name in containers if name not in idle]
+
+        rc = 0
+        for _ in range(self.pool_size - len(idle)):
+            rc = self._run_pool_container(
+                pool_prefix + binascii.hexlify(os.urandom(4)).decode("ascii"))
+            if rc:
+                break
+
+        claimed.sort(key=self._last_used, reverse=True)
+        for name in claimed[self.pool_max_instances:]:
+            lock_path = os.path.join(self.cache_directory, "instances",
+                                     "%s.lock" % name)
+            if not os.path.isdir(os.path.dirname(lock_path)):
+                os.makedirs(os.path.dirname(lock_path))
+            lock_file = _try_lock(lock_path)
+            if lock_file is None:
+                continue
+            try:
+                logger.info("Removing idle container '%s'..." % name)
+                self._run_silent_command(self._with_docker_machine(
+                    "%s rm -f %s >/dev/null 2>&1" % (self.docker_command,
+                                                     name)))
+            finally:
+                lock_file.close()
+        return rc
+
+    def _claim_pool_container(self):
+        """Renames a warm pool container to our instance name."""
+        containers = self._query_docker("list_containers", "%s=%s" %
+                                        (POOL_LABEL, self._pool_fingerprint()))
+        pool_prefix = "%s_pool_" % self.base_instance_name
+        for name in containers:
+            if not name.startswith(pool_prefix):
+                continue
+            # Renaming is atomic, so only one invocation can claim each
+            # container.
+            command = "%s rm -f %s >/dev/null 2>&1 ; " % (self.docker_command,
+                                                          self.instance_name)
+            command += "%s rename %s %s >/dev/null 2>&1" % (
+                self.docker_command, name, self.instance_name)
+            command = self._with_docker_machine(command)
+            if self._run_silent_command(command) == 0:
+                logger.info("Claimed warm container '%s'" % name)
+                return True
+        return False
+
+    def _run_pool_container(self, name):
+        """Runs a warm pool container, and warms bazel up inside it."""
+        real_pool_root = os.path.realpath(self.pool_root)
+        real_output_root = os.path.realpath(self.bazel_user_output_root)
+        volumes = self.user_volumes + [
+            "%s:%s" % (real_pool_root, real_pool_root),
+            "%s:%s%s" % (real_output_root, real_output_root,
+                         self.delegated_volume_flag),
+        ]
+        if self.shared_cache_directory:
+            volumes += [
+                "%s:%s%s" % (self.shared_cache_directory,
+                             self.shared_cache_directory,
+                             self.delegated_volume_flag)
+            ]
+        if self.build_report:
+            volumes += ["%s:%s" % (self.build_events_directory,
+                                   self.build_events_directory)]
+        logger.info("Starting warm pool container '%s'..." % name)
+        command = "%s run -id --name=%s --label %s=%s %s %s -w %s %s %s %s %s" % (
+            self.docker_command, name, POOL_LABEL, self._pool_fingerprint(),
+            "--privileged" if self.docker_run_privileged else "",
+            self._resource_run_flags(),
+            real_pool_root, '-v "%s"' % '" -v "'.join(volumes),
+            ("--net=%s" % self.network) if self.network else "",
+            self._pool_image(), self.run_command if self.run_command else "")
+        rc = self._run_silent_command(self._with_docker_machine(command))
+        if rc or not self.command:
             return rc
 
-        # Run the container itself.
-        return self._run_container()
+        # Extract bazel's install base and load it into the page cache, so that
+        # the first command of the claiming workspace starts faster.
+        command = "%s exec -d %s %s --output_user_root=%s version" % (
+            self.docker_exec_command, name, self.command,
+            TEMP_BAZEL_OUTPUT_USER_ROOT)
+        self._run_silent_command(self._with_docker_machine(command))
+        return 0
+
+    def _pool_image(self):
+        """Returns the image of the pool containers, shared by workspaces."""
+        if self.dockerfile and os.path.exists(self.dockerfile):
+            return self._content_image()
+        return "%s%s" % (("%s/" % self.repository) if self.repository else "",
+                         self.image_name)
+
+    def _pool_fingerprint(self):
+        """Returns a hash of everything that pool containers are started with."""
+        values = [
+            self._pool_image(), self.base_instance_name, self.pool_root,
+            self.bazel_user_output_root, self.user_volumes, self.network,
+            self.run_command, self.docker_run_privileged,
+            self.shared_cache_directory, self.resources, self.build_report
+        ]
+        return hashlib.sha1(
+            json.dumps(values).encode("utf-8")).hexdigest()[:16]
+
+    def _last_used(self, instance_name):
+        """Returns when the container was last used by a dazel command."""
+        try:
+            return os.path.getmtime(os.path.join(
+                self.cache_directory, "instances", "%s.json" % instance_name))
+        except OSError:
+            return 0
+
+    def _acquire_image(self):
+        """Builds or pulls the relevant dazel image.
+
+        A pulled image is pinned to its digest in the dazel run file, and is
+        only pulled again once the pin is older than DAZEL_IMAGE_PIN_TTL (or on
+        `dazel prefetch`), as long as the local image still has that digest.
+        """
+        if os.path.exists(self.dockerfile):
+            return self._build()
+
+        if self._is_image_pin_fresh():
+            return 0
+
+        rc = self._pull()
+        # If we have the image, don't stop everything just because we
+        # couldn't pull.
+        if rc and self._image_exists():
+            rc = 0
+        if not rc:
+            self._pin_image()
+        return rc
+
+    def _image_reference(self):
+        """Returns the repository/image_name of the pulled image."""
+        return "%s/%s" % (self.repository, self.image_name)
 
+    def _is_image_pin_fresh(self):
+        """Checks if the local image is the one we pinned, recently enough."""
+        pin = self._image_pin or (self.load_state() or {}).get("image_pin")
+        if (not pin or pin.get("reference") != self._image_reference() or
+                time.time() - pin.get("resolved_at", 0) > self.image_pin_ttl):
+            return False
+        info = self._query_docker("inspect_image", self._image_reference())
+        if info is None or info.get("Id") != pin.get("id"):
+            return False
+        self._image_pin = pin
+        return True
+
+    def _pin_image(self):
+        """Pins the local image to its current digest."""
+        info = self._query_docker("inspect_image", self._image_reference())
+        if info is None:
+            return
+        self._image_pin = {
+            "reference": self._image_reference(),
+            "id": info.get("Id"),
+            "repo_digest": (info.get("RepoDigests") or [None])[0],
+            "resolved_at": time.time(),
+        }
+
+    def prefetch(self):
+        """Pulls the dazel image and the images of the dependencies.
+
+        The pulls run concurrently, and the dazel image is pinned again.
+        """
+        if not self._docker_exists():
+            logger.error("ERROR: Docker executable could not be found!")
+            return 1
+
+        scheduler = StartupScheduler(self.startup_concurrency)
+        if not os.path.exists(self.dockerfile):
+            scheduler.add("image", self._pull)
+        for (run_dep_image, run_dep_name) in self.run_deps:
+            scheduler.add("run_dep:%s" % run_dep_name, self._pull_image,
+                          args=(run_dep_image,))
+        if self.remote_cache and not self.remote_cache_url:
+            scheduler.add("remote_cache", self._pull_image,
+                          args=(self.remote_cache_image,))
+        if self.docker_compose_file and self._docker_compose_exists():
+            scheduler.add("compose", self._pull_compose_services)
+        rc = scheduler.run()
+
+        if "image" in scheduler.steps():
+            self._pin_image()
+            if self._image_pin and self.dazel_run_file:
+                state = self.load_state() or {
+                    "version": DAZEL_RUN_FILE_VERSION
+                }
+                state["image_pin"] = self._image_pin
+                _write_json_file(self.dazel_run_file, state)
+        return rc
+
+    @traced("dazel")
+    def _ensure_network(self):
+        """Sets up the network if necessary."""
+        if self._network_exists():
+            return 0
+        logger.info("Creating network: '%s'" % self.network)
+        return self._start_network()
+
+    @traced("dazel")
+    def load_state(self):
+        """Loads the state recorded in the dazel run file (None if missing)."""
+        if not self.dazel_run_file:
+            return None
+        try:
+            with open(self.dazel_run_file, "r") as run_file:
+                state = json.load(run_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if (not isinstance(state, dict) or
+                state.get("version") != DAZEL_RUN_FILE_VERSION):
+            return None
+        return state
+
+    def is_state_fresh(self, state):
+        """Checks if the recorded state matches our current configuration.
+
+        This only costs a few stats, so that warm invocations can send the
+        command to the container without probing it first.
+        """
+        if (state is None or
+                state.get("instance_name") != self.instance_name or
+                state.get("fingerprint") != self.config_fingerprint() or
+                not self._is_image_digest_fresh(state)):
+            return False
+
+        # Another workspace may have replaced the container since (when sharing
+        # the instance name), which is recorded in the host-wide registry.
+        record = self.load_instance_record()
+        return (record is not None and
+                record.get("container_id") == state.get("container_id"))
+
+    def save_state(self, info=None):
+        """Records the state of the running container in the dazel run file."""
+        if not self.dazel_run_file:
+            return
+        if info is None:
+            info = self._query_docker("inspect_container",
+                                      self.instance_name) or {}
+        state = {
+            "version": DAZEL_RUN_FILE_VERSION,
+            "instance_name": self.instance_name,
+            "container_id": info.get("Id"),
+            "image_id": info.get("Image"),
+            "mounts": sorted(info.get("HostConfig", {}).get("Binds") or []),
+            "network": info.get("HostConfig", {}).get("NetworkMode"),
+            "fingerprint": self.config_fingerprint(),
+            "image_digest": self.image_digest(),
+            "image_context_stamp": self.image_context_stamp(),
+        }
+        image_pin = self._image_pin or (self.load_state() or {}).get(
+            "image_pin")
+        if image_pin:
+            state["image_pin"] = image_pin
+        host_config = info.get("HostConfig", {})
+        if host_config.get("NanoCpus") or host_config.get("Memory"):
+            state["resources"] = {
+                "cpus": (host_config.get("NanoCpus") or 0) / 1e9,
+                "memory": host_config.get("Memory") or 0,
+            }
+        if self.remote_cache and not self.remote_cache_url:
+            address = self._remote_cache_instance().published_address(
+                REMOTE_CACHE_HTTP_PORT)
+            if address:
+                state["remote_cache_metrics_url"] = "http://%s:%d/metrics" % (
+                    address)
+
+        _write_json_file(self.dazel_run_file, state)
+        self.save_instance_record(state)
+
+    def load_instance_record(self):
+        """Loads the host-wide record of the container (None if missing)."""
+        try:
+            with open(self._instance_record_file(), "r") as record_file:
+                return json.load(record_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save_instance_record(self, state):
+        """Records which workspace the container currently belongs to."""
+        record = {
+            "instance_name": self.instance_name,
+            "container_id": state.get("container_id"),
+            "directory": os.path.realpath(self.directory),
+            "dazel_run_file": self.dazel_run_file,
+            "docker_command": self.docker_command,
+        }
+        # Only the output base and image of this very workspace can be deleted
+        # along with the container.
+        if (self.workspace_hex_digest and os.path.basename(
+                self.bazel_output_base) == self.workspace_hex_digest):
+            record["output_base"] = self.bazel_output_base
+        if self.image_name != self.base_image_name:
+            record["image"] = self.image_name
+        volumes = self.named_volumes()
+        if volumes:
+            record["volumes"] = volumes
+        _write_json_file(self._instance_record_file(), record)
+
+    def named_volumes(self):
+        """Returns the names of the volumes of the "volume" and "sync" modes."""
+        return [
+            "%s_%s" % (self.instance_name, path)
+            for (path, mode) in sorted(self.mount_modes.items())
+            if mode in ("volume", "sync")
+        ]
+
+    def touch_instance_record(self):
+        """Marks the container as used now (for LRU eviction)."""
+        try:
+            os.utime(self._instance_record_file(), None)
+        except OSError:
+            pass
+
+    def _instance_record_file(self):
+        return os.path.join(self.cache_directory, "instances",
+                            "%s.json" % self.instance_name)
+
+    def config_fingerprint(self):
+        """Returns a hash of the resolved configuration of the container."""
+        values = [(attribute, getattr(self, attribute, None))
+                  for attribute in CONTAINER_FINGERPRINT_ATTRIBUTES]
+        return hashlib.sha1(
+            json.dumps(values, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @traced("dazel")
     def is_running(self):
         """Checks if the container is currently running."""
-        command = "%s ps | grep \"\\<%s\\>\" >/dev/null 2>&1" % (
-            self.docker_command, self.instance_name)
-        command = self._with_docker_machine(command)
+        # A single inspection gives us the state, mounts and network together.
+        info = self._query_docker("inspect_container", self.instance_name)
+        if not info or not info.get("State", {}).get("Running"):
+            return False
 
         # If we have a directory, make sure the running container is mapped to
         # the same one (if not we need to create a new container mapped to the
         # correct folder).
         if self.directory:
             real_directory = os.path.realpath(self.directory)
-            command += (
-                " && docker inspect \"%s\" | grep \"%s:%s\" >/dev/null 2>&1" %
-                (self.instance_name, real_directory, real_directory))
+            if not self._container_mounts(info, real_directory):
+                return False
 
         # If we have a network, make sure the running container is using the
         # correct network (if not we need to create a new container on the
         # correct network).
         # Note: with proper naming conventions this shouldn't happen much.
         if self.network:
-            command += (
-                " && docker inspect \"%s\" | grep '\"NetworkMode\": \"%s\"' >/dev/null 2>&1"
-                % (self.instance_name, self.network))
+            network_mode = info.get("HostConfig", {}).get("NetworkMode")
+            if network_mode != self.network:
+                return False
+
+        return True
+
+    @property
+    def transport(self):
+        """The transport used to query the docker daemon."""
+        if self._transport is None:
+            self._transport = self._create_transport()
+        return self._transport
+
+    def _create_transport(self):
+        """Creates the docker transport according to the configuration."""
+        cli_transport = DockerCliTransport(self.docker_command,
+                                           self._with_docker_machine)
+        if self.docker_transport == "cli":
+            return cli_transport
+
+        # The API transport talks to the daemon in our environment, so it is
+        # only picked automatically when the docker command would talk to the
+        # same one: a plain `docker` (not `docker -H ...`, `sudo docker` or
+        # podman) in the default context, and no docker-machine.
+        if self.docker_transport == "api" or (
+                self.docker_machine is None and
+                shlex.split(self.docker_command) == ["docker"] and
+                _docker_context() == "default" and
+                DockerApiTransport.is_available()):
+            return DockerApiTransport()
+        return cli_transport
+
+    def _query_docker(self, query, *args):
+        """Runs a query on the docker transport, falling back to the CLI."""
+        try:
+            return getattr(self.transport, query)(*args)
+        except DockerTransportError as e:
+            if self.docker_transport == "api":
+                raise
+            logger.debug("Falling back to the docker CLI: %s" % e)
+            self.transport.close()
+            self._transport = DockerCliTransport(self.docker_command,
+                                                 self._with_docker_machine)
+            return getattr(self._transport, query)(*args)
+
+    def image_digest(self):
+        """Returns the content digest of the image's Dockerfile and context.
+
+        This is None when the image is pulled rather than built.
+        """
+        if not self.dockerfile or not os.path.exists(self.dockerfile):
+            return None
+        return self._get_build_context().digest()
+
+    def image_context_stamp(self):
+        """Returns the cheap fingerprint of the image's build context, if any."""
+        if not self.dockerfile or not os.path.exists(self.dockerfile):
+            return None
+        return self._get_build_context().stamp()
+
+    def _is_image_digest_fresh(self, state):
+        """Checks if the image's content digest is still the recorded one.
+
+        Hashing the whole build context can take long on large workspaces, so
+        it is only done when the context's stamp changed. Edits deep in a
+        copied directory are noticed when the container is (re)started, which
+        computes the digest again.
+        """
+        stamp = self.image_context_stamp()
+        if stamp is not None and stamp == state.get("image_context_stamp"):
+            return True
+        if state.get("image_digest") != self.image_digest():
+            return False
+        # The context was touched without changing, so record the new stamp.
+        if stamp is not None and self.dazel_run_file:
+            _write_json_file(self.dazel_run_file,
+                             dict(state, image_context_stamp=stamp))
+        return True
+
+    def _get_build_context(self):
+        if self._build_context is None:
+            real_directory = os.path.realpath(self.directory)
+            digest_cache = DigestCache(
+                os.path.join(self.cache_directory, "digests", "%s.json" %
+                             hashlib.md5(real_directory.encode(
+                                 "utf-8")).hexdigest()))
+            excluded = [os.path.join(self.directory, DAZEL_CONFIG_CACHE_FILE)]
+            if self.dazel_run_file:
+                excluded.append(self.dazel_run_file)
+            self._build_context = BuildContext(self.directory, self.dockerfile,
+                                               digest_cache, excluded)
+        return self._build_context
+
+    def _content_image(self):
+        """Returns the image tagged with the content digest of the image.
+
+        The tag doesn't depend on the workspace, so that an image built from
+        the same content is reused across workspaces and branches.
+        """
+        return "%s/%s:dazel-%s" % (self.repository, self.base_image_name,
+                                   self.image_digest()[:24])
+
+    @staticmethod
+    def _container_mounts(info, real_directory):
+        """Checks if the inspected container maps the directory to itself.
+
+        The directory may also be mapped through one of its ancestors (as in
+        warm pool containers, which map the whole pool root).
+        """
+        def maps_directory(source, destination):
+            return source == destination and (
+                real_directory == source or
+                real_directory.startswith(source.rstrip("/") + "/"))
 
-        rc = self._run_silent_command(command)
-        return (rc == 0)
+        for bind in info.get("HostConfig", {}).get("Binds") or []:
+            if maps_directory(*bind.split(":")[:2]):
+                return True
+        for mount in info.get("Mounts") or []:
+            if maps_directory(mount.get("Source"), mount.get("Destination")):
+                return True
+        return False
 
     def _run_silent_command(self, command):
-        return subprocess.call(command, stdout=sys.stderr, shell=True)
+        with _span("docker command", "docker", {"command": command}):
+            return subprocess.call(command, stdout=sys.stderr, shell=True)
 
     def _image_exists(self):
         """Checks if the dazel image exists in the local repository."""
-        command = "%s images | grep \"\\<%s/%s\\>\" >/dev/null 2>&1" % (
-            self.docker_command, self.repository, self.image_name)
-        command = self._with_docker_machine(command)
-        rc = self._run_silent_command(command)
-        return (rc == 0)
+        return self._query_docker("image_exists", self._image_reference())
 
+    @traced("dazel")
     def _build(self):
         """Builds the dazel image from the local dockerfile."""
         if not os.path.exists(self.dockerfile):
             raise RuntimeError("No Dockerfile to build the dazel image from.")
 
-        command = "%s build -t %s/%s -f %s %s" % (self.docker_command,
-                                                  self.repository,
-                                                  self.image_name,
-                                                  self.dockerfile,
-                                                  self.directory)
-        command = self._with_docker_machine(command)
-        return self._run_silent_command(command)
+        # If an image was already built from the same content, just tag it.
+        content_image = self._content_image()
+        if self._query_docker("image_exists", content_image):
+            logger.info("Reusing image '%s'" % content_image)
+            command = "%s tag %s %s/%s" % (self.docker_command, content_image,
+                                           self.repository, self.image_name)
+            command = self._with_docker_machine(command)
+            return self._run_silent_command(command)
 
+        # Only send docker the files that the Dockerfile actually uses, rather
+        # than the whole directory.
+        build_context = self._get_build_context()
+        logger.info("Building image '%s' from %d context files..." %
+                    (content_image, len(build_context.files())))
+        return self._query_docker(
+            "build", ["%s/%s" % (self.repository, self.image_name),
+                      content_image], BUILD_CONTEXT_DOCKERFILE,
+            build_context.write_tar)
+
+    @traced("dazel")
     def _pull(self):
         """Pulls the relevant image from the dockerhub repository."""
         if not self.repository:
             raise RuntimeError("No repository to pull the dazel image from.")
 
-        command = "%s pull %s/%s" % (self.docker_command, self.repository,
-                                     self.image_name)
+        return self._pull_image(self._image_reference())
+
+    def _pull_image(self, image):
+        """Pulls the given image."""
+        command = "%s pull %s" % (self.docker_command, image)
+        command = self._with_docker_machine(command)
+        return self._run_silent_command(command)
+
+    def _pull_compose_services(self):
+        """Pulls the images of the docker-compose services."""
+        command = "COMPOSE_PROJECT_NAME=%s %s -f %s pull --ignore-pull-failures %s" % (
+            self.docker_compose_project_name, self.docker_compose_command,
+            self.docker_compose_file, self.docker_compose_services)
         command = self._with_docker_machine(command)
         return self._run_silent_command(command)
 
     def _network_exists(self):
         """Checks if the network we need to use exists."""
-        command = "%s network ls | grep \"\\<%s\\>\" >/dev/null 2>&1" % (
-            self.docker_command, self.network)
-        command = self._with_docker_machine(command)
-        rc = self._run_silent_command(command)
-        return (rc == 0)
+        return self._query_docker("network_exists", self.network)
 
     def _start_network(self):
         """Starts the docker network the container will use."""
@@ -292,53 +3071,142 @@ class DockerInstance:
         command = self._with_docker_machine(command)
         return self._run_silent_command(command)
 
-    def _start_run_deps(self):
-        """Starts the containers that are marked as runtime dependencies."""
-        for (run_dep_image, run_dep_name) in self.run_deps:
-            run_dep_instance = DockerInstance(
-                instance_name=run_dep_name,
-                image_name=run_dep_image,
-                run_command=None,
-                docker_command=None,
-                dockerfile=None,
-                repository=None,
-                directory=None,
-                command=None,
-                volumes=None,
-                ports=None,
-                network=self.network,
-                run_deps=None,
-                docker_compose_file=None,
-                docker_compose_command=None,
-                docker_compose_project_name=None,
-                docker_compose_services=None,
-                bazel_rc_file=None,
-                bazel_user_output_root=None,
-                docker_run_privileged=self.docker_run_privileged,
-                docker_machine=self.docker_machine,
-                dazel_run_file=None)
-            if not run_dep_instance.is_running():
-                logger.info("Starting run dependency: '%s' (name: '%s')" %
-                            (run_dep_image, run_dep_name))
-                run_dep_instance._run_container()
+    @traced("dazel")
+    def _start_run_dep(self, run_dep_image, run_dep_name):
+        """Starts a container that is marked as a runtime dependency."""
+        run_dep_instance = self._run_dep_instance(run_dep_image, run_dep_name)
+        if run_dep_instance.is_running():
+            return 0
+        logger.info("Starting run dependency: '%s' (name: '%s')" %
+                    (run_dep_image, run_dep_name))
+        return run_dep_instance._run_container()
+
+    def container_address(self):
+        """Returns the address of the container on its network, or None."""
+        info = self._query_docker("inspect_container", self.instance_name) or {}
+        networks = info.get("NetworkSettings", {}).get("Networks") or {}
+        return (networks.get(self.network) or {}).get("IPAddress")
+
+    def published_address(self, port):
+        """Returns the (host, port) the container's TCP port is published on.
+
+        Returns None if the port is not published. Unlike the address of the
+        container on its network, it can be reached from the host on Docker
+        Desktop and rootless docker as well.
+        """
+        info = self._query_docker("inspect_container", self.instance_name) or {}
+        ports = info.get("NetworkSettings", {}).get("Ports") or {}
+        for binding in ports.get("%d/tcp" % port) or []:
+            if binding.get("HostPort"):
+                host = binding.get("HostIp") or "127.0.0.1"
+                if host in ("0.0.0.0", "::"):
+                    host = "127.0.0.1"
+                return host, int(binding["HostPort"])
+        return None
+
+    def _run_dep_instance(self, run_dep_image, run_dep_name):
+        """Creates the DockerInstance of a runtime dependency."""
+        return DockerInstance(
+            instance_name=run_dep_name,
+            image_name=run_dep_image,
+            run_command=None,
+            docker_command=self.docker_command,
+            docker_exec_command=self.docker_exec_command,
+            dockerfile=None,
+            repository=None,
+            directory=None,
+            command=None,
+            volumes=None,
+            ports=None,
+            network=self.network,
+            run_deps=None,
+            docker_compose_file=None,
+            docker_compose_command=None,
+            docker_compose_project_name=None,
+            docker_compose_services=None,
+            bazel_rc_file=None,
+            bazel_user_output_root=None,
+            docker_run_privileged=self.docker_run_privileged,
+            docker_machine=self.docker_machine,
+            dazel_run_file=None,
+            workspace_hex=False,
+            delegated_volume=False,
+            docker_transport=self.docker_transport,
+            cache_directory=self.cache_directory)
 
+    @traced("dazel")
     def _start_compose_services(self):
-        """Starts the docker-compose services."""
+        """Starts the docker-compose services.
+
+        Only the services whose definition changed since their running
+        container was created (or that aren't running) are pulled, built and
+        recreated. The others are left running as they are.
+        """
         if not self.docker_compose_file:
             return 0
 
+        services = self.docker_compose_services
+        config_hashes = self._compose_config_hashes()
+        if config_hashes is not None:
+            changed_services = self._changed_compose_services(config_hashes)
+            if not changed_services:
+                logger.info("docker-compose services are up to date.")
+                return 0
+            logger.info("Updating docker-compose services: %s" %
+                        ", ".join(changed_services))
+            services = " ".join(changed_services)
+
         command = "COMPOSE_PROJECT_NAME=%s %s -f %s pull --ignore-pull-failures %s" % (
             self.docker_compose_project_name, self.docker_compose_command,
-            self.docker_compose_file, self.docker_compose_services)
+            self.docker_compose_file, services)
         command += " && COMPOSE_PROJECT_NAME=%s %s -f %s build %s" % (
             self.docker_compose_project_name, self.docker_compose_command,
-            self.docker_compose_file, self.docker_compose_services)
-        command += " && COMPOSE_PROJECT_NAME=%s %s -f %s up --force-recreate -d %s" % (
+            self.docker_compose_file, services)
+        command += " && COMPOSE_PROJECT_NAME=%s %s -f %s up -d %s" % (
             self.docker_compose_project_name, self.docker_compose_command,
-            self.docker_compose_file, self.docker_compose_services)
+            self.docker_compose_file, services)
         command = self._with_docker_machine(command)
         return self._run_silent_command(command)
 
+    def _compose_config_hashes(self):
+        """Returns the configuration hash of each selected service.
+
+        These are the hashes that docker-compose labels the service containers
+        with. Returns None if docker-compose can't compute them (before 1.25).
+        """
+        command = "COMPOSE_PROJECT_NAME=%s %s -f %s config --hash=%s" % (
+            self.docker_compose_project_name, self.docker_compose_command,
+            self.docker_compose_file, shell_quote(
+                ",".join(self.docker_compose_services.split()) or "*"))
+        command = self._with_docker_machine(command)
+        with open(os.devnull, "w") as devnull:
+            process = subprocess.Popen(command, shell=True,
+                                       stdout=subprocess.PIPE, stderr=devnull)
+            output = process.communicate()[0].decode("utf-8", "replace")
+        if process.returncode:
+            return None
+        return dict(
+            line.split()[:2] for line in output.splitlines()
+            if len(line.split()) >= 2)
+
+    def _changed_compose_services(self, config_hashes):
+        """Returns the services without a running container of their hash."""
+        running = set(
+            (labels["com.docker.compose.service"],
+             labels["com.docker.compose.config-hash"])
+            for labels in self._query_docker(
+                "list_container_labels",
+                "com.docker.compose.project=%s" %
+                self.docker_compose_project_name,
+                ["com.docker.compose.service",
+                 "com.docker.compose.config-hash",
+                 "com.docker.compose.oneoff"])
+            if labels["com.docker.compose.oneoff"] != "True")
+        return sorted(service
+                      for (service, config_hash) in config_hashes.items()
+                      if (service, config_hash) not in running)
+
+    @traced("dazel")
     def _run_container(self):
         """Runs the container itself."""
         logger.info("Starting docker container '%s'..." % self.instance_name)
@@ -346,9 +3214,9 @@ class DockerInstance:
                                                      self.instance_name)
         command += "%s rm %s >/dev/null 2>&1 ; " % (self.docker_command,
                                                     self.instance_name)
-        command += "%s run -id --name=%s %s %s %s %s %s %s%s %s" % (
+        command += "%s run -id --name=%s %s %s %s %s %s %s %s%s %s" % (
             self.docker_command, self.instance_name, "--privileged"
-            if self.docker_run_privileged else "",
+            if self.docker_run_privileged else "", self._resource_run_flags(),
             ("-w %s" % os.path.realpath(self.directory))
             if self.directory else "", self.volumes, self.ports,
             ("--net=%s" % self.network)
@@ -360,9 +3228,9 @@ class DockerInstance:
         if rc:
             return rc
 
-        # Touch the dazel run file to change the timestamp.
+        # Record the new container in the dazel run file.
         if self.dazel_run_file:
-            open(self.dazel_run_file, "w").write(self.instance_name + "\n")
+            self.save_state()
             logger.info("Done.")
 
         return rc
@@ -371,22 +3239,34 @@ class DockerInstance:
         """Add the given volumes to the run string, and the bazel volumes we need anyway."""
         # This can only be intentional in code, so ignore None volumes.
         self.volumes = ""
+        self.user_volumes = []
+        self.output_directories = []
         if volumes is None:
             return
+        tmpfs_mounts = []
 
         # DAZEL_VOLUMES can be a python iterable or a comma-separated string.
         if isinstance(volumes, str):
             volumes = [v.strip() for v in volumes.split(",")]
-        elif volumes and not isinstance(volumes, types.Iterable):
+        elif volumes and not isinstance(volumes, Iterable):
             raise RuntimeError("DAZEL_VOLUMES must be comma-separated string "
                                "or python iterable of strings")
 
-        # Find the real source and output directories.
+        self.user_volumes = list(volumes)
+
+        # Find the real source and output directories (without modifying the
+        # configured list, which other instances may be created from).
         real_directory = os.path.realpath(self.directory)
-        volumes += [
+        volumes = list(volumes) + [
             "%s:%s" % (real_directory, real_directory),
         ]
 
+        # Bazel writes the build events of reported commands to the host.
+        if self.build_report:
+            self.output_directories.append(self.build_events_directory)
+            volumes += ["%s:%s" % (self.build_events_directory,
+                                   self.build_events_directory)]
+
         # If the user hasn't explicitly set a DAZEL_BAZEL_USER_OUTPUT_ROOT for
         # bazel, set it from the output directory so that we get the build
         # results on the host.
@@ -407,15 +3287,29 @@ class DockerInstance:
 
             user_output_paths = (DEFAULT_BAZEL_USER_OUTPUT_PATHS +
                                  [os.path.basename(real_directory)])
-            for user_output_path in user_output_paths:
+            for user_output_path in user_output_paths + MOUNT_MODE_EXTRA_PATHS:
                 real_user_output_path = os.path.realpath(
                     os.path.join(self.bazel_output_base, user_output_path))
-                if not os.path.isdir(real_user_output_path):
-                    os.makedirs(real_user_output_path)
-                volumes += [
-                    "%s:%s%s" % (real_user_output_path, real_user_output_path,
-                                 self.delegated_volume_flag)
-                ]
+                mode = self.mount_modes.get(
+                    user_output_path,
+                    "bind" if user_output_path in user_output_paths else None)
+                if mode == "bind":
+                    self.output_directories.append(real_user_output_path)
+                    volumes += [
+                        "%s:%s%s" % (real_user_output_path,
+                                     real_user_output_path,
+                                     self.delegated_volume_flag)
+                    ]
+                elif mode in ("volume", "sync"):
+                    # Named volumes live in the docker daemon's filesystem,
+                    # which is much faster than bind mounts on Docker Desktop
+                    # and rootless docker.
+                    volumes += [
+                        "%s_%s:%s" % (self.instance_name, user_output_path,
+                                      real_user_output_path)
+                    ]
+                elif mode == "tmpfs":
+                    tmpfs_mounts += [real_user_output_path]
         elif real_bazelout:
             volumes += [
                 "%s:%s%s" % (real_bazelout, real_bazelout,
@@ -423,13 +3317,201 @@ class DockerInstance:
             ]
             self.bazel_output_base = real_bazelout
 
-        # Make sure the path exists on the host.
-        if self.bazel_user_output_root and not os.path.isdir(
-                self.bazel_user_output_root):
-            os.makedirs(self.bazel_user_output_root)
+        # Map the cache shared by all of the containers.
+        if self.shared_cache_directory:
+            volumes += [
+                "%s:%s%s" % (self.shared_cache_directory,
+                             self.shared_cache_directory,
+                             self.delegated_volume_flag)
+            ]
+            self.output_directories += [
+                self.shared_cache.repository_cache, self.shared_cache.disk_cache
+            ]
+
+        # Make sure the paths exist on the host.
+        if self.bazel_user_output_root:
+            self.output_directories.append(self.bazel_user_output_root)
+        self._make_output_directories()
 
         # Calculate the volumes string.
         self.volumes = '-v "%s"' % '" -v "'.join(volumes)
+        self.volumes += "".join(' --tmpfs "%s:exec"' % mount
+                                for mount in tmpfs_mounts)
+
+    def _add_mount_modes(self, mount_modes):
+        """Adds how to mount each path of the output base."""
+        # DAZEL_MOUNT_MODES can be a python dictionary or a semicolon-separated
+        # string of "path=mode" pairs.
+        if isinstance(mount_modes, str):
+            mount_modes = dict(
+                tuple(s.strip() for s in pair.split("=", 1))
+                for pair in mount_modes.split(";") if "=" in pair)
+        elif not isinstance(mount_modes, dict):
+            raise RuntimeError("DAZEL_MOUNT_MODES must be a "
+                               "semicolon-separated string or python dict")
+
+        for (path, mode) in mount_modes.items():
+            if mode not in MOUNT_MODES:
+                raise RuntimeError("Unknown mount mode '%s' for '%s' (must be "
+                                   "one of: %s)" % (mode, path,
+                                                    ", ".join(MOUNT_MODES)))
+            if mode == "sync" and path != "execroot":
+                raise RuntimeError("Only the execroot can be mounted in sync "
+                                   "mode, which syncs bazel-bin back on demand")
+        self.mount_modes = mount_modes
+
+    def _add_resources(self, resources):
+        """Adds the resource profile of the container."""
+        # DAZEL_RESOURCES can be a python dictionary, "auto", or a
+        # semicolon-separated string of "limit=value" pairs (which can be
+        # combined with "auto" to override some of the automatic limits).
+        if isinstance(resources, str):
+            resources = dict(
+                tuple(s.strip() for s in pair.split("=", 1))
+                if "=" in pair else (pair.strip(), True)
+                for pair in resources.split(";") if pair.strip())
+        elif not isinstance(resources, dict):
+            raise RuntimeError("DAZEL_RESOURCES must be \"auto\", a "
+                               "semicolon-separated string or python dict")
+
+        for key in resources:
+            if key not in RESOURCE_KEYS + ["auto"]:
+                raise RuntimeError("Unknown resource limit '%s' (must be one "
+                                   "of: %s)" % (key, ", ".join(RESOURCE_KEYS)))
+        self.resources = resources
+
+    def _add_shard_hosts(self, shard_hosts):
+        """Adds the docker hosts that test shards run on."""
+        # DAZEL_SHARD_HOSTS can be a python iterable or a comma-separated string.
+        if isinstance(shard_hosts, str):
+            shard_hosts = [h.strip() for h in shard_hosts.split(",") if h.strip()]
+        elif not isinstance(shard_hosts, Iterable):
+            raise RuntimeError("DAZEL_SHARD_HOSTS must be comma-separated "
+                               "string or python iterable of strings")
+        self.shard_hosts = list(shard_hosts)
+
+    def shard_instance(self, index):
+        """Creates the DockerInstance of the given test shard.
+
+        Each shard (but the first, which is this instance) has its own
+        container, and its own run file and bazel output root in the shards
+        directory, and runs on the next of the shard hosts. The workspace (and
+        the cache directory) must be at the same path on all of them.
+        """
+        if index == 0:
+            return self
+        overrides = {
+            "DAZEL_INSTANCE_NAME": "%s_shard%d" % (self.base_instance_name,
+                                                   index),
+            "DAZEL_RUN_FILE": os.path.join(self.shards_directory(),
+                                           "run%d.json" % index),
+            "DAZEL_BAZEL_USER_OUTPUT_ROOT": os.path.join(
+                self.shards_directory(), "output%d" % index),
+        }
+        host = self.shard_host(index)
+        if host:
+            overrides.update({
+                "DAZEL_DOCKER_COMMAND": "%s -H %s" % (self.docker_command,
+                                                      host),
+                "DAZEL_DOCKER_EXEC_COMMAND": "%s -H %s" % (
+                    self.docker_exec_command, host),
+                "DAZEL_DOCKER_TRANSPORT": "cli",
+            })
+        return DockerInstance._resolve_config(overrides)
+
+    def shard_host(self, index):
+        """Returns the docker host of the given test shard ("" if local)."""
+        if index == 0 or not self.shard_hosts:
+            return ""
+        return self.shard_hosts[index % len(self.shard_hosts)]
+
+    def shards_directory(self):
+        """Returns the directory of the test shards' state, logs and report."""
+        return os.path.join(self.cache_directory, "shards", self.instance_name)
+
+    def resource_limits(self):
+        """Returns the cpus, memory and shm size to start the container with.
+
+        In auto mode, the container gets (its share of) the host's cores and of
+        the memory that is available at the time.
+        """
+        limits = {}
+        if self.resources.get("auto"):
+            share = float(self.resources.get("share", 1))
+            limits["cpus"] = max(1, int(_host_cpus() / share))
+            available_memory = _host_available_memory()
+            if available_memory:
+                limits["memory"] = int(available_memory *
+                                       AUTO_RESOURCES_MEMORY_FRACTION / share)
+                limits["shm"] = int(limits["memory"] *
+                                    AUTO_RESOURCES_SHM_FRACTION)
+        if "cpus" in self.resources:
+            limits["cpus"] = float(self.resources["cpus"])
+        for key in ["memory", "shm"]:
+            if key in self.resources:
+                limits[key] = _parse_size(self.resources[key])
+        return limits
+
+    def _resource_run_flags(self):
+        """Returns the docker run flags of the container's resource limits."""
+        limits = self.resource_limits()
+        flags = []
+        if limits.get("cpus"):
+            flags += ["--cpus=%g" % limits["cpus"]]
+        if limits.get("memory"):
+            flags += ["--memory=%d" % limits["memory"]]
+        if limits.get("shm"):
+            flags += ["--shm-size=%d" % limits["shm"]]
+        return " ".join(flags)
+
+    def sync(self, paths):
+        """Copies bazel-bin (or the given paths in it) back to the host.
+
+        This is for the "sync" mount mode, where the execroot lives in a named
+        volume, and is only seen by the host through `dazel sync-outputs`.
+        """
+        if self.mount_modes.get("execroot") != "sync":
+            logger.error("ERROR: The execroot is not mounted in sync mode.")
+            return 1
+
+        # Find bazel-bin, which is at the same path in the container and on the
+        # host (where the bazel-bin symlink of the workspace points).
+        process = subprocess.Popen(
+            self.wrap_argv(self.exec_prefix(tty=False, term="") +
+                           self.bazel_argv(["info", "bazel-bin"])),
+            stdout=subprocess.PIPE)
+        bazel_bin = process.communicate()[0].decode("utf-8").strip()
+        if process.returncode or not bazel_bin:
+            logger.error("ERROR: Could not find bazel-bin in the container.")
+            return process.returncode or 1
+
+        # Stream the files as a tar archive, and extract them as they come.
+        command = self.exec_prefix(tty=False, term="")
+        command[command.index(self.instance_name):0] = ["-w", bazel_bin]
+        process = subprocess.Popen(
+            self.wrap_argv(command + ["tar", "cf", "-"] + (paths or ["."])),
+            stdout=subprocess.PIPE)
+        files, size = 0, 0
+        with tarfile.open(fileobj=process.stdout, mode="r|") as archive:
+            # bazel-bin holds absolute symlinks, and comes from our own
+            # container.
+            if hasattr(tarfile, "fully_trusted_filter"):
+                archive.extraction_filter = tarfile.fully_trusted_filter
+            for member in archive:
+                archive.extract(member, bazel_bin)
+                if member.isfile():
+                    files += 1
+                    size += member.size
+        rc = process.wait()
+        sys.stderr.write("Synced %d files (%s) to %s\n" %
+                         (files, _format_size(size), bazel_bin))
+        return rc
+
+    def _make_output_directories(self):
+        """Creates the output directories we map, if they don't exist."""
+        for directory in self.output_directories:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
 
     def _add_ports(self, ports):
         """Add the given ports to the run string."""
@@ -441,7 +3523,7 @@ class DockerInstance:
         # DAZEL_PORTS can be a python iterable or a comma-separated string.
         if isinstance(ports, str):
             ports = [p.strip() for p in ports.split(",")]
-        elif ports and not isinstance(ports, types.Iterable):
+        elif ports and not isinstance(ports, Iterable):
             raise RuntimeError("DAZEL_PORTS must be comma-separated string "
                                "or python iterable of strings")
 
@@ -458,7 +3540,7 @@ class DockerInstance:
         # DAZEL_RUN_DEPS can be a python iterable or a comma-separated string.
         if isinstance(run_deps, str):
             run_deps = [rd.strip() for rd in run_deps.split(",")]
-        elif run_deps and not isinstance(run_deps, types.Iterable):
+        elif run_deps and not isinstance(run_deps, Iterable):
             raise RuntimeError("DAZEL_RUN_DEPS must be comma-separated string "
                                "or python iterable of strings")
 
@@ -471,6 +3553,26 @@ class DockerInstance:
 
         self.run_deps = [extract_image_and_instance(rd) for rd in run_deps]
 
+    def _add_run_deps_readiness(self, run_deps_readiness):
+        """Adds the readiness probes of the runtime container dependencies."""
+        self.run_deps_readiness = {}
+        if not run_deps_readiness:
+            return
+
+        # DAZEL_RUN_DEPS_READINESS can be a python dictionary or a
+        # semicolon-separated string of "name=probe" pairs.
+        if isinstance(run_deps_readiness, str):
+            run_deps_readiness = dict(
+                tuple(s.strip() for s in pair.split("=", 1))
+                for pair in run_deps_readiness.split(";") if "=" in pair)
+        elif not isinstance(run_deps_readiness, dict):
+            raise RuntimeError("DAZEL_RUN_DEPS_READINESS must be a "
+                               "semicolon-separated string or python dict")
+
+        for spec in run_deps_readiness.values():
+            ReadinessProbe.validate(spec)
+        self.run_deps_readiness = run_deps_readiness
+
     def _add_compose_services(self, docker_compose_services):
         """Add the given services to the docker-compose up string."""
         # This can only be intentional in code, so ignore None services.
@@ -485,7 +3587,7 @@ class DockerInstance:
                 s.strip() for s in docker_compose_services.split(",")
             ]
         elif docker_compose_services and not isinstance(
-                docker_compose_services, types.Iterable):
+                docker_compose_services, Iterable):
             raise RuntimeError(
                 "DAZEL_DOCKER_COMPOSE_SERVICES must be comma-separated string "
                 "or python iterable of strings")
@@ -503,18 +3605,16 @@ class DockerInstance:
 
     def _command_exists(self, cmd):
         """Checks if a command exists on the system."""
-        command = "which %s >/dev/null 2>&1" % (cmd)
-        rc = self._run_silent_command(command)
-        return (rc == 0)
+        return _command_exists(cmd)
 
     def _with_docker_machine(self, cmd):
-        if self.docker_machine is None or not self._command_exists(
-                "docker-machine"):
+        if self.docker_machine is None or not _command_exists("docker-machine"):
             return cmd
         return "eval $(docker-machine env %s) && (%s)" % (self.docker_machine,
                                                           cmd)
 
     @classmethod
+    @traced("dazel")
     def _config_from_file(cls):
         """Creates a configuration from a .dazelrc file."""
         directory = cls._find_workspace_directory()
@@ -543,34 +3643,1200 @@ class DockerInstance:
         }
 
     @classmethod
+    @traced("dazel")
     def _find_workspace_directory(cls):
         """Find the workspace directory.
 
         This is done by traversing the directory structure from the given dazel
-        directory until we find the WORKSPACE file.
+        directory until we find a WORKSPACE, WORKSPACE.bazel or MODULE.bazel
+        file. The result is remembered for the process, and across processes in
+        a memo in the cache directory, which only takes a single stat to check.
         """
-        directory = os.path.realpath(
+        start_directory = os.path.abspath(
             os.environ.get("DAZEL_DIRECTORY", DEFAULT_DIRECTORY))
-        while (directory and directory != "/" and not os.path.exists(
-                os.path.join(directory, BAZEL_WORKSPACE_FILE))):
-            directory = os.path.dirname(directory)
+        if start_directory in _workspace_directory_cache:
+            return _workspace_directory_cache[start_directory]
+
+        memo_path = os.path.join(
+            _normalize_cache_directory(os.environ.get(
+                "DAZEL_CACHE_DIRECTORY", DEFAULT_CACHE_DIRECTORY)),
+            "workspaces.json")
+        try:
+            with open(memo_path, "r") as memo_file:
+                memo = json.load(memo_file)
+        except (IOError, OSError, ValueError):
+            memo = {}
+
+        directory, workspace_file = memo.get(start_directory, (None, None))
+        if not (directory and
+                os.path.isfile(os.path.join(directory, workspace_file))):
+            directory, workspace_file = cls._walk_to_workspace(start_directory)
+            if workspace_file:
+                memo[start_directory] = [directory, workspace_file]
+                for stale_directory in list(memo)[:-WORKSPACE_MEMO_SIZE]:
+                    del memo[stale_directory]
+                try:
+                    _write_json_file(memo_path, memo)
+                except (IOError, OSError) as e:
+                    logger.debug("Could not save the workspace memo: %s" % e)
+
+        _workspace_directory_cache[start_directory] = directory
         return directory
 
+    @staticmethod
+    def _walk_to_workspace(start_directory):
+        """Returns the closest workspace directory and the file marking it."""
+        directory = os.path.realpath(start_directory)
+        while directory and directory != "/":
+            for workspace_file in BAZEL_WORKSPACE_FILES:
+                if os.path.isfile(os.path.join(directory, workspace_file)):
+                    return directory, workspace_file
+            directory = os.path.dirname(directory)
+        return directory, None
+
+
+class DazelServer(object):
+    """A per-workspace server that runs commands on behalf of thin clients.
+
+    The server resolves the configuration and the container once, and then
+    multiplexes the commands it receives on its unix socket into the container,
+    streaming their stdout, stderr and exit codes back to the clients. It shuts
+    down when idle for too long, or when a client presents a configuration
+    fingerprint that differs from its own (the client then starts a new one).
+    """
+
+    # Frame kinds exchanged on the socket, each frame being a one byte kind and
+    # a four byte length followed by the payload.
+    REQUEST = b"q"
+    STDOUT = b"o"
+    STDERR = b"e"
+    EXIT = b"x"
+    RESTART = b"r"
+
+    def __init__(self, socket_path, fingerprint, idle_timeout):
+        self.socket_path = socket_path
+        self.fingerprint = fingerprint
+        self.idle_timeout = idle_timeout
+        self.instance = DockerInstance.from_config()
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._active = 0
+        self._last_activity = time.time()
+        self._stopping = False
+        self._lock_file = None
+
+    def serve(self):
+        """Serves clients until idle or restarted, returns the exit code."""
+        # Only a single server may own the socket of a workspace.
+        self._lock_file = open(self.socket_path + ".lock", "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            logger.info("Another dazel server is running for this workspace.")
+            return 0
+
+        # Shut down gracefully when asked to.
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen(16)
+        try:
+            while not self._stopping:
+                readable = select.select([listener], [], [], 1)[0]
+                if readable:
+                    connection = listener.accept()[0]
+                    with self._lock:
+                        self._active += 1
+                    thread = threading.Thread(target=self._handle,
+                                              args=(connection,))
+                    thread.daemon = True
+                    thread.start()
+                elif self._is_idle():
+                    logger.info("Shutting down idle dazel server.")
+                    break
+        finally:
+            listener.close()
+            self._release_socket()
+
+        # Let the commands that are still running finish.
+        while self._active:
+            time.sleep(0.1)
+        return 0
+
+    def stop(self):
+        """Stops accepting commands, and exits once the running ones finish."""
+        self._stopping = True
+
+    def _release_socket(self):
+        """Hands the socket path over to the next server of the workspace."""
+        with self._lock:
+            if self._lock_file is None:
+                return
+            os.remove(self.socket_path)
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _is_idle(self):
+        with self._lock:
+            return (not self._active and
+                    time.time() - self._last_activity > self.idle_timeout)
+
+    def _handle(self, connection):
+        """Handles a single client request."""
+        try:
+            kind, payload = _recv_frame(connection)
+            request = json.loads(payload.decode("utf-8"))
+            if request.get("fingerprint") != self.fingerprint:
+                # Our configuration is outdated, stop accepting commands so
+                # that the client can start a fresh server.
+                self.stop()
+                self._release_socket()
+                _send_frame(connection, self.RESTART, b"")
+                return
+            rc = self._run(connection, request)
+            _send_frame(connection, self.EXIT, str(rc).encode("ascii"))
+        except (socket.error, ValueError) as e:
+            logger.warning("dazel server request failed: %s" % e)
+        finally:
+            connection.close()
+            with self._lock:
+                self._active -= 1
+                self._last_activity = time.time()
+
+    def _run(self, connection, request):
+        """Runs the command in the container, streaming the output back."""
+        with self._start_lock:
+            self.instance.reset_image_state()
+            if not self.instance.is_state_fresh(self.instance.load_state()):
+                rc = self.instance.start()
+                if rc:
+                    return rc
+
+        rc = self._stream(connection, request)
+        if rc:
+            with self._start_lock:
+                if self.instance.is_running():
+                    return rc
+                rc = self.instance.start()
+            if not rc:
+                rc = self._stream(connection, request)
+        return rc
+
+    def _stream(self, connection, request):
+        command = self.instance.exec_command(request["args"], tty=False,
+                                             term=request.get("term", ""))
+        lock_file = self.instance.lock_shared_cache(request["args"])
+        with open(os.devnull, "r") as devnull:
+            process = subprocess.Popen(command, stdin=devnull,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+        send_lock = threading.Lock()
+
+        def pump(stream, kind):
+            for chunk in iter(lambda: os.read(stream.fileno(), 65536), b""):
+                try:
+                    with send_lock:
+                        _send_frame(connection, kind, chunk)
+                except socket.error:
+                    # The client is gone (e.g. interrupted), so don't keep the
+                    # command running for nobody.
+                    process.kill()
+                    return
+
+        stderr_thread = threading.Thread(target=pump,
+                                         args=(process.stderr, self.STDERR))
+        stderr_thread.start()
+        try:
+            pump(process.stdout, self.STDOUT)
+        finally:
+            stderr_thread.join()
+            process.wait()
+            if lock_file:
+                lock_file.close()
+        if process.returncode < 0:
+            return 128 - process.returncode
+        return process.returncode
+
+
+def _send_frame(connection, kind, payload):
+    connection.sendall(struct.pack(">cI", kind, len(payload)) + payload)
+
+
+def _recv_frame(connection):
+    kind, length = struct.unpack(">cI", _recv_exactly(connection, 5))
+    return kind, _recv_exactly(connection, length)
+
+
+def _recv_exactly(connection, size):
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise socket.error("Connection closed by the dazel server.")
+        data += chunk
+    return data
+
+
+def _config_fingerprint(workspace_directory):
+    """Returns a cheap fingerprint of the configuration sources.
+
+    This only stats the .dazelrc file and reads the environment, so that it can
+    be computed without resolving the configuration itself.
+    """
+    dazelrc_path = os.environ.get(
+        "DAZEL_RC_FILE", os.path.join(workspace_directory, DAZEL_RC_FILE))
+    try:
+        dazelrc_stat = os.stat(dazelrc_path)
+        dazelrc_key = [dazelrc_stat.st_mtime, dazelrc_stat.st_size,
+                       dazelrc_stat.st_ino]
+    except OSError:
+        dazelrc_key = None
+    environment = sorted((name, value)
+                         for (name, value) in os.environ.items()
+                         if name.startswith("DAZEL_") and
+                         name not in ("DAZEL_SERVER", "DAZEL_TRACE"))
+    return hashlib.sha1(
+        json.dumps([dazelrc_path, dazelrc_key, environment]).encode(
+            "utf-8")).hexdigest()
+
+
+def _server_socket_path(workspace_directory):
+    """Returns the socket of the dazel server of the given workspace."""
+    cache_directory = _normalize_cache_directory(
+        os.environ.get("DAZEL_CACHE_DIRECTORY", DEFAULT_CACHE_DIRECTORY))
+    digest = hashlib.md5(
+        workspace_directory.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_directory, "servers", "%s.sock" % digest)
+
+
+def run_server():
+    """Runs the dazel server of the current workspace in the foreground."""
+    workspace_directory = DockerInstance._find_workspace_directory()
+    socket_path = _server_socket_path(workspace_directory)
+    if not os.path.isdir(os.path.dirname(socket_path)):
+        os.makedirs(os.path.dirname(socket_path))
+    server = DazelServer(
+        socket_path=socket_path,
+        fingerprint=_config_fingerprint(workspace_directory),
+        idle_timeout=float(os.environ.get("DAZEL_SERVER_IDLE_TIMEOUT",
+                                          DEFAULT_SERVER_IDLE_TIMEOUT)))
+    return server.serve()
+
+
+@traced("command")
+def send_to_server(args):
+    """Sends the command to the workspace's dazel server, starting it if needed.
+
+    Returns the exit code of the command, or None if no server could be reached
+    (in which case the command should be run directly).
+    """
+    workspace_directory = DockerInstance._find_workspace_directory()
+    socket_path = _server_socket_path(workspace_directory)
+    request = json.dumps({
+        "args": args,
+        "fingerprint": _config_fingerprint(workspace_directory),
+        "term": os.environ.get("TERM", ""),
+    }).encode("utf-8")
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    stderr = getattr(sys.stderr, "buffer", sys.stderr)
+
+    # Allow a single restart, for when the server has an outdated configuration.
+    for _ in range(2):
+        connection = _connect_to_server(socket_path)
+        if connection is None:
+            return None
+        try:
+            _send_frame(connection, DazelServer.REQUEST, request)
+            while True:
+                kind, payload = _recv_frame(connection)
+                if kind == DazelServer.STDOUT:
+                    stdout.write(payload)
+                    stdout.flush()
+                elif kind == DazelServer.STDERR:
+                    stderr.write(payload)
+                    stderr.flush()
+                elif kind == DazelServer.EXIT:
+                    return int(payload.decode("ascii"))
+                elif kind == DazelServer.RESTART:
+                    _wait_for_server_exit(socket_path)
+                    break
+        except socket.error as e:
+            logger.warning("Lost connection to the dazel server: %s" % e)
+            return None
+        finally:
+            connection.close()
+    return None
+
+
+def _connect_to_server(socket_path):
+    """Connects to the server on the socket, starting it if it isn't running."""
+    started = False
+    deadline = time.time() + SERVER_START_TIMEOUT
+    while time.time() < deadline:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(socket_path)
+            return connection
+        except socket.error as e:
+            connection.close()
+            if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+                return None
+        if not started:
+            _start_server(socket_path)
+            started = True
+        time.sleep(0.05)
+    logger.warning("Timed out waiting for the dazel server to start.")
+    return None
+
+
+def _start_server(socket_path):
+    """Starts the dazel server in the background, detached from our session."""
+    directory = os.path.dirname(socket_path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    _spawn_detached(["--server"], os.path.splitext(socket_path)[0] + ".log")
+
+
+def _spawn_detached(args, log_path=os.devnull):
+    """Runs dazel with the given arguments in the background, detached."""
+    # Background processes outlive the command being traced.
+    environment = dict(os.environ)
+    environment.pop("DAZEL_TRACE", None)
+    with open(os.devnull, "r") as devnull, open(log_path, "a") as log_file:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__)] + args,
+                         stdin=devnull, stdout=log_file, stderr=log_file,
+                         env=environment, preexec_fn=os.setsid,
+                         close_fds=True)
+
+
+def _wait_for_server_exit(socket_path):
+    deadline = time.time() + SERVER_START_TIMEOUT
+    while os.path.exists(socket_path) and time.time() < deadline:
+        time.sleep(0.05)
+
+
+class BatchSession(object):
+    """Runs bazel commands one after another in a single docker exec session.
+
+    The session is a shell in the container, which runs each command with its
+    output going to stderr, and then reports its exit code on stdout after a
+    random marker.
+    """
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.marker = "dazel-%s" % binascii.hexlify(os.urandom(8)).decode(
+            "ascii")
+        self.process = subprocess.Popen(
+            instance.wrap_argv(
+                instance.exec_prefix(tty=False, term="") + ["/bin/sh"]),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def run(self, args):
+        """Runs the bazel command, returning its exit code (or None)."""
+        command = " ".join(
+            shell_quote(arg) for arg in self.instance.bazel_argv(args))
+        script = "%s </dev/null 1>&2; echo %s $?\n" % (command, self.marker)
+        lock_file = self.instance.lock_shared_cache(args)
+        try:
+            with _span(" ".join(args[:2]), "command"):
+                self.process.stdin.write(script.encode("utf-8"))
+                self.process.stdin.flush()
+                for line in iter(self.process.stdout.readline, b""):
+                    line = line.decode("utf-8", "replace")
+                    if line.startswith(self.marker + " "):
+                        return int(line.split()[1])
+                    sys.stderr.write(line)
+        except (IOError, OSError):
+            pass
+        finally:
+            if lock_file:
+                lock_file.close()
+        return None
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.process.wait()
+
+
+def _read_batch_commands(path):
+    """Reads the command lines of a batch (from stdin if path is "-").
+
+    Blank lines and comments are skipped, as is a leading "bazel" or "dazel".
+    """
+    if path == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open(path, "r") as batch_file:
+            lines = batch_file.readlines()
+    commands = []
+    for line in lines:
+        args = shlex.split(line, comments=True)
+        if args and args[0] in ("bazel", "dazel"):
+            args = args[1:]
+        if args:
+            commands.append(args)
+    return commands
+
+
+def run_batch(di, args):
+    """Runs `dazel batch [--jobs=N] [--keep_going] [FILE]`.
+
+    The commands (from FILE, or stdin) run in a single session in the
+    container, which is only checked once. Consecutive read-only commands
+    (queries, info...) run concurrently in up to N sessions, although bazel
+    itself still runs one command at a time per output base. For each command,
+    a JSON line with its exit code and timing is written to stdout, and its own
+    output goes to stderr. Unless --keep_going is given, the batch stops at the
+    first failure.
+    """
+    jobs, keep_going, path = 1, False, "-"
+    for arg in args:
+        if arg.startswith("--jobs="):
+            jobs = max(int(arg.split("=", 1)[1]), 1)
+        elif arg == "--keep_going":
+            keep_going = True
+        else:
+            path = arg
+    commands = _read_batch_commands(path)
+
+    # Check the container once for the whole batch.
+    if not (di.is_state_fresh(di.load_state()) and di.is_running()):
+        rc = di.start()
+        if rc:
+            return rc
+    di.touch_instance_record()
+
+    # Group consecutive read-only commands to run them concurrently.
+    groups = []
+    for (index, command) in enumerate(commands):
+        read_only = (jobs > 1 and
+                     DockerInstance._command_verb(command) in READ_ONLY_COMMANDS)
+        if read_only and groups and groups[-1][0]:
+            groups[-1][1].append((index, command))
+        else:
+            groups.append((read_only, [(index, command)]))
+
+    sessions = [BatchSession(di)]
+    output_lock = threading.Lock()
+    failures = []
+
+    def run_command(session, index, command):
+        start = time.time()
+        rc = session.run(command)
+        with output_lock:
+            sys.stdout.write("%s\n" % json.dumps({
+                "index": index,
+                "args": command,
+                "exit_code": 255 if rc is None else rc,
+                "seconds": round(time.time() - start, 3),
+            }))
+            sys.stdout.flush()
+            if rc != 0:
+                failures.append((index, 255 if rc is None else rc))
+
+    def run_commands(session, queue):
+        while queue and (keep_going or not failures):
+            with output_lock:
+                if not queue:
+                    return
+                index, command = queue.pop(0)
+            run_command(session, index, command)
+
+    try:
+        for (read_only, group) in groups:
+            if not keep_going and failures:
+                break
+            while len(sessions) < min(jobs, len(group)):
+                sessions.append(BatchSession(di))
+            threads = [
+                threading.Thread(target=run_commands, args=(session, group))
+                for session in sessions[1:min(jobs, len(group))]
+            ]
+            for thread in threads:
+                thread.start()
+            run_commands(sessions[0], group)
+            for thread in threads:
+                thread.join()
+    finally:
+        for session in sessions:
+            session.close()
+
+    return min(failures)[1] if failures else 0
+
+
+def is_sharded_test(args):
+    """Checks if the arguments are a `dazel test --shards=N ...` command."""
+    return (args[:1] == ["test"] and
+            any(arg.startswith("--shards=") for arg in args[1:]))
+
+
+def run_sharded_test(di, args):
+    """Runs `dazel test --shards=N [OPTIONS] TARGETS...`.
+
+    The test targets are resolved with `bazel query` in the container, and
+    split into N shards of about the same duration (from the durations of
+    previous runs), which run concurrently in their own containers. The
+    results of all the shards are merged into a single report. Options must be
+    given in their --option=value form, to tell them apart from targets.
+    """
+    shards, options, patterns = 1, [], []
+    for (index, arg) in enumerate(args):
+        if arg == "--":
+            patterns += args[index + 1:]
+            break
+        if arg.startswith("--shards="):
+            shards = max(int(arg.split("=", 1)[1]), 1)
+        elif arg.startswith("-"):
+            options.append(arg)
+        else:
+            patterns.append(arg)
+
+    if not (di.is_state_fresh(di.load_state()) and di.is_running()):
+        rc = di.start()
+        if rc:
+            return rc
+    di.touch_instance_record()
+
+    targets = _query_tests(di, patterns)
+    if targets is None:
+        return 1
+    if not targets:
+        logger.error("ERROR: No test targets were found.")
+        return 4
+
+    durations_path = os.path.join(di.cache_directory, "test_durations",
+                                  "%s.json" % hashlib.md5(os.path.realpath(
+                                      di.directory).encode("utf-8")).hexdigest())
+    try:
+        with open(durations_path, "r") as durations_file:
+            durations = json.load(durations_file)
+    except (IOError, OSError, ValueError):
+        durations = {}
+    partitions = _partition_tests(targets, durations, shards)
+
+    # Start the shard containers, and run their tests as they come up.
+    log_directory = di.shards_directory()
+    if not os.path.isdir(log_directory):
+        os.makedirs(log_directory)
+    results = [None] * len(partitions)
+    # The shards on a docker host share its network and run dependencies, so
+    # they start one at a time on each host: the first one creates them, and
+    # the others find them running (rather than racing to create them, or
+    # restarting each other's dependencies).
+    start_locks = dict((di.shard_host(index), threading.Lock())
+                       for index in range(len(partitions)))
+
+    def run_shard(index):
+        start = time.time()
+        log_path = os.path.join(log_directory, "shard%d.log" % index)
+        instance = di.shard_instance(index)
+        result = {
+            "index": index,
+            "instance": instance.instance_name,
+            "targets": len(partitions[index]),
+            "log": log_path,
+        }
+        results[index] = result
+        with start_locks[di.shard_host(index)]:
+            if not (instance.is_state_fresh(instance.load_state()) and
+                    instance.is_running()):
+                rc = instance.start()
+                if rc:
+                    result.update(exit_code=rc, seconds=time.time() - start)
+                    return
+        command = instance.exec_command(
+            ["test"] + options +
+            ["--symlink_prefix=/", "--color=no", "--curses=no", "--"] +
+            partitions[index], tty=False, term="")
+        lock_file = instance.lock_shared_cache(["test"])
+        try:
+            with open(log_path, "w") as log_file:
+                with open(os.devnull, "r") as devnull:
+                    rc = subprocess.call(command, stdin=devnull,
+                                         stdout=log_file,
+                                         stderr=subprocess.STDOUT)
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+        result.update(exit_code=rc, seconds=time.time() - start)
+
+    logger.info("Running %d test targets in %d shards..." %
+                (len(targets), len(partitions)))
+    threads = [threading.Thread(target=run_shard, args=(index,))
+               for index in range(len(partitions))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Merge the shards' test summaries.
+    tests = {}
+    for (index, result) in enumerate(results):
+        summary = _read_test_summary(result["log"])
+        for target in partitions[index]:
+            tests[target] = dict(summary.get(target, {"status": "NO STATUS"}),
+                                 shard=index)
+    for (target, test) in tests.items():
+        if test.get("seconds") is not None and not test.get("cached"):
+            durations[target] = test["seconds"]
+    _write_json_file(durations_path, durations)
+
+    exit_codes = [result.get("exit_code", 1) for result in results]
+    failures = [rc for rc in exit_codes if rc not in (0, 4)]
+    if failures:
+        rc = max(failures)
+    else:
+        rc = 4 if all(code == 4 for code in exit_codes) else 0
+    _write_json_file(os.path.join(log_directory, "report.json"), {
+        "exit_code": rc,
+        "shards": results,
+        "tests": tests,
+    })
+
+    for target in sorted(tests):
+        test = tests[target]
+        sys.stdout.write("%-60s %s%s%s\n" % (
+            target, "(cached) " if test.get("cached") else "", test["status"],
+            " in %.1fs" % test["seconds"]
+            if test.get("seconds") is not None else ""))
+    for result in results:
+        sys.stdout.write("Shard %d (%s): %d targets, exit code %d in %.1fs, "
+                         "log: %s\n" % (result["index"], result["instance"],
+                                        result["targets"],
+                                        result.get("exit_code", 1),
+                                        result.get("seconds", 0),
+                                        result["log"]))
+    statuses = [test["status"] for test in tests.values()]
+    sys.stdout.write("Executed %d test targets in %d shards: %d passed, %d "
+                     "failed.\n" % (len(tests), len(results),
+                                    statuses.count("PASSED"),
+                                    len(statuses) - statuses.count("PASSED")))
+    return rc
+
+
+def _query_tests(di, patterns):
+    """Returns the test targets of the target patterns (None on errors).
+
+    Like `bazel test`, tests tagged "manual" are only included when they are
+    given explicitly, rather than through a wildcard.
+    """
+    terms = []
+    for pattern in patterns:
+        if pattern.startswith("-"):
+            terms.append("- %s" % pattern[1:])
+        elif "..." in pattern or pattern.endswith((":all", ":*")):
+            terms.append("+ (tests(%s) except attr(tags, '\\bmanual\\b', "
+                         "tests(%s)))" % (pattern, pattern))
+        else:
+            terms.append("+ tests(%s)" % pattern)
+    if not terms or not terms[0].startswith("+"):
+        logger.error("ERROR: No test targets were given.")
+        return None
+    expression = " ".join(terms)[2:]
+
+    process = subprocess.Popen(
+        di.exec_command(["query", "--output=label", expression], tty=False,
+                        term=""), stdout=subprocess.PIPE)
+    output = process.communicate()[0].decode("utf-8", "replace")
+    if process.returncode:
+        logger.error("ERROR: Could not query the test targets.")
+        return None
+    return [line.strip() for line in output.splitlines() if line.strip()]
+
+
+def _partition_tests(targets, durations, shards):
+    """Splits the targets into shards of about the same total duration.
+
+    This is the longest processing time first heuristic: the longest tests are
+    placed first, each in the shard with the least work so far. Tests that
+    haven't run before are assumed to take the average duration.
+    """
+    known = [durations[target] for target in targets if target in durations]
+    default = (sum(known) / len(known)) if known else DEFAULT_TEST_DURATION
+    partitions = [[] for _ in range(min(shards, len(targets)))]
+    loads = [0.0] * len(partitions)
+    for target in sorted(targets, key=lambda t: (-durations.get(t, default),
+                                                 t)):
+        index = loads.index(min(loads))
+        partitions[index].append(target)
+        loads[index] += durations.get(target, default)
+    return partitions
+
+
+def _read_test_summary(log_path):
+    """Returns the status and duration of each test in a bazel test log."""
+    summary = {}
+    try:
+        with open(log_path, "r") as log_file:
+            for line in log_file:
+                match = TEST_SUMMARY_REGEX.match(line.rstrip())
+                if match:
+                    summary[match.group(1)] = {
+                        "status": match.group(3),
+                        "cached": bool(match.group(2)),
+                        "seconds": float(match.group(4))
+                        if match.group(4) else None,
+                    }
+    except (IOError, OSError):
+        pass
+    return summary
+
+
+def _remote_cache_counters(metrics_url):
+    """Returns the action cache (hits, misses) counted by the remote cache.
+
+    Returns None if there is no remote cache, or its metrics can't be read.
+    """
+    if not metrics_url:
+        return None
+    try:
+        response = urlopen(metrics_url, timeout=REMOTE_CACHE_METRICS_TIMEOUT)
+        metrics = response.read().decode("utf-8", "replace")
+    except (IOError, OSError, ValueError, socket.error):
+        return None
+
+    counters = {"hit": 0, "miss": 0}
+    for line in metrics.splitlines():
+        if (not line.startswith("bazel_remote_incoming_requests_total{") or
+                'kind="AC"' not in line or 'method="GET"' not in line):
+            continue
+        for status in counters:
+            if 'status="%s"' % status in line:
+                counters[status] += int(float(line.rsplit(None, 1)[-1]))
+    return counters["hit"], counters["miss"]
+
+
+def _report_remote_cache_hits(before, after):
+    """Writes the remote cache hit rate of the command to stderr."""
+    if after is None:
+        return
+    hits, misses = after[0] - before[0], after[1] - before[1]
+    if hits + misses <= 0:
+        return
+    sys.stderr.write("dazel: remote cache: %d hits, %d misses (%.1f%% hit "
+                     "rate)\n" % (hits, misses, 100.0 * hits /
+                                   (hits + misses)))
+
+
+def run_cache_command(di, args):
+    """Runs `dazel cache gc [--max_size=SIZE]` or `dazel cache stats`."""
+    shared_cache = di.shared_cache
+    if shared_cache is None:
+        logger.error("ERROR: DAZEL_SHARED_CACHE_DIRECTORY is not set.")
+        return 1
+
+    if args[:1] == ["stats"]:
+        sys.stdout.write("%s\n" % json.dumps(shared_cache.stats(), indent=2,
+                                              sort_keys=True))
+        return 0
+
+    if args[:1] == ["gc"]:
+        max_size = di.shared_cache_max_size
+        for arg in args[1:]:
+            if arg.startswith("--max_size="):
+                max_size = _parse_size(arg.split("=", 1)[1])
+        result = shared_cache.gc(max_size)
+        if result is None:
+            logger.error("ERROR: The shared cache stayed in use for more than "
+                         "%ds." % SHARED_CACHE_LOCK_TIMEOUT)
+            return 1
+        sys.stdout.write("Deleted %d entries (%s) from %s.\n" %
+                         (result[0], _format_size(result[1]),
+                          shared_cache.directory))
+        return 0
+
+    logger.error("ERROR: Usage: dazel cache gc [--max_size=SIZE] | "
+                 "dazel cache stats")
+    return 1
+
+
+def run_gc(di, args):
+    """Runs `dazel gc [--idle_timeout=SECONDS] [--max_size=SIZE] [--dry_run]`.
+
+    Using the host-wide instance records (whose modification time is the last
+    time each container was used), this:
+    - removes the containers of workspaces that no longer exist, along with
+      their output bases and workspace-specific image tags,
+    - stops the containers that were idle for longer than the timeout (which
+      frees their bazel servers' memory), and
+    - removes the least recently used containers and their output bases while
+      the output bases take more than the size budget (if any).
+    Containers on other docker hosts, being started, or running commands (such
+    as long builds or `bazel run` servers) are left alone.
+    """
+    idle_timeout, max_size, dry_run = di.gc_idle_timeout, di.gc_max_size, False
+    for arg in args:
+        if arg.startswith("--idle_timeout="):
+            idle_timeout = float(arg.split("=", 1)[1])
+        elif arg.startswith("--max_size="):
+            max_size = _parse_size(arg.split("=", 1)[1])
+        elif arg == "--dry_run":
+            dry_run = True
+        else:
+            logger.error("ERROR: Usage: dazel gc [--idle_timeout=SECONDS] "
+                         "[--max_size=SIZE] [--dry_run]")
+            return 1
+
+    records = []
+    for path in glob.glob(os.path.join(di.cache_directory, "instances",
+                                       "*.json")):
+        try:
+            with open(path, "r") as record_file:
+                record = json.load(record_file)
+            record["last_used"] = os.path.getmtime(path)
+        except (IOError, OSError, ValueError):
+            continue
+        if record.get("docker_command", di.docker_command) == di.docker_command:
+            record["path"] = path
+            records.append(record)
+    records.sort(key=lambda record: record["last_used"])
+
+    # The named volumes of the mount modes are sized by docker.
+    volume_sizes = {}
+    if any(record.get("volumes") for record in records):
+        volume_sizes = di._query_docker("volume_sizes")
+
+    removed, stopped, memory, deleted, disk = 0, 0, 0, 0, 0
+    kept = []
+    now = time.time()
+    for record in records:
+        lock_file = _try_lock(os.path.splitext(record["path"])[0] + ".lock")
+        if lock_file is None:
+            continue
+        try:
+            name = record["instance_name"]
+            info = di._query_docker("inspect_container", name)
+            running = bool(info and info.get("State", {}).get("Running"))
+            if _is_container_busy(info):
+                kept.append(record)
+            elif not os.path.isdir(record.get("directory", "")):
+                logger.info("Removing '%s' (its workspace '%s' is gone)..." %
+                            (name, record.get("directory")))
+                memory += _container_memory(di, name, running)
+                disk += _remove_instance(di, record, running, dry_run,
+                                         volume_sizes)
+                removed += 1
+                deleted += 1 if record.get("output_base") else 0
+            elif running and now - record["last_used"] > idle_timeout:
+                logger.info("Stopping '%s' (idle for %ds)..." %
+                            (name, now - record["last_used"]))
+                memory += _container_memory(di, name, running)
+                if not dry_run:
+                    di._run_silent_command(di._with_docker_machine(
+                        "%s stop %s >/dev/null 2>&1" % (di.docker_command,
+                                                        name)))
+                stopped += 1
+                kept.append(record)
+            else:
+                kept.append(record)
+        finally:
+            lock_file.close()
+
+    # Enforce the size budget of the output bases (and volumes), least recently
+    # used first.
+    if max_size is not None:
+        sizes = dict((record["path"], _instance_size(record, volume_sizes))
+                     for record in kept
+                     if record.get("output_base") or record.get("volumes"))
+        total_size = sum(sizes.values())
+        for record in kept:
+            if total_size <= max_size:
+                break
+            if record["path"] not in sizes:
+                continue
+            lock_file = _try_lock(os.path.splitext(record["path"])[0] +
+                                  ".lock")
+            if lock_file is None:
+                continue
+            try:
+                name = record["instance_name"]
+                info = di._query_docker("inspect_container", name)
+                if _is_container_busy(info):
+                    continue
+                logger.info("Removing '%s' (its output base is among the least "
+                            "recently used)..." % name)
+                running = bool(info and info.get("State", {}).get("Running"))
+                memory += _container_memory(di, name, running)
+                total_size -= sizes[record["path"]]
+                disk += _remove_instance(di, record, running, dry_run,
+                                         volume_sizes)
+                removed += 1
+                deleted += 1 if record.get("output_base") else 0
+            finally:
+                lock_file.close()
+
+    sys.stdout.write("%sStopped %d idle containers and removed %d, reclaiming "
+                     "%s of memory; deleted %d output bases, reclaiming %s of "
+                     "disk.\n" % ("(dry run) " if dry_run else "", stopped,
+                                  removed, _format_size(memory), deleted,
+                                  _format_size(disk)))
+    return 0
+
+
+def _try_lock(path):
+    """Returns the locked file, or None if it is locked elsewhere."""
+    lock_file = open(path, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return lock_file
+    except (IOError, OSError) as e:
+        lock_file.close()
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return None
+
+
+def _is_container_busy(info):
+    """Checks if the inspected container is running commands (`docker exec`)."""
+    return bool(info and info.get("State", {}).get("Running") and
+                info.get("ExecIDs"))
+
+
+def _container_memory(di, name, running):
+    """Returns the memory used by the container (0 if unknown)."""
+    if not running:
+        return 0
+    return di._query_docker("container_memory", name) or 0
+
+
+def _instance_size(record, volume_sizes):
+    """Returns the bytes used by the recorded output base and volumes."""
+    output_base = record.get("output_base")
+    return ((_directory_size(output_base) if output_base else 0) +
+            sum(volume_sizes.get(volume, 0)
+                for volume in record.get("volumes") or []))
+
+
+def _remove_instance(di, record, running, dry_run, volume_sizes):
+    """Removes the recorded container, output base, volumes and image tag.
+
+    The record and the workspace's run file are removed too, so the next
+    command in the workspace starts a new container. Returns the bytes freed.
+    """
+    name = record["instance_name"]
+    output_base = record.get("output_base")
+    size = _instance_size(record, volume_sizes)
+    if dry_run:
+        return size
+
+    # The container may have created files the host user can't delete.
+    if output_base and running:
+        di._run_silent_command(di._with_docker_machine(
+            "%s exec %s rm -rf %s >/dev/null 2>&1" % (
+                di.docker_command, name, shell_quote(output_base))))
+    di._run_silent_command(di._with_docker_machine(
+        "%s rm -f %s >/dev/null 2>&1" % (di.docker_command, name)))
+    for volume in record.get("volumes") or []:
+        if di._run_silent_command(di._with_docker_machine(
+                "%s volume rm %s >/dev/null 2>&1" % (di.docker_command,
+                                                     volume))):
+            size -= volume_sizes.get(volume, 0)
+    if record.get("image"):
+        di._run_silent_command(di._with_docker_machine(
+            "%s rmi %s >/dev/null 2>&1" % (di.docker_command,
+                                           record["image"])))
+    if output_base:
+        shutil.rmtree(output_base, ignore_errors=True)
+        if os.path.exists(output_base):
+            logger.warning("Could not delete all of '%s'." % output_base)
+            size -= _directory_size(output_base)
+    for path in [record.get("dazel_run_file"), record["path"],
+                 os.path.splitext(record["path"])[0] + ".lock",
+                 os.path.splitext(record["path"])[0] + ".pids"]:
+        try:
+            os.remove(path)
+        except (OSError, TypeError):
+            pass
+    return size
+
+
+def _directory_size(path):
+    """Returns the total size of the files under the directory."""
+    size = 0
+    for (root, _, names) in os.walk(path):
+        for name in names:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def run_report(di, args):
+    """Runs `dazel report [--limit=N] [--all] [--json]`.
+
+    Lists the reported builds of the workspace (or of all workspaces, with
+    --all) from the build history, oldest first. Each successful build is
+    compared with the median bazel time of the previous successful builds of
+    the same command, and flagged as a regression when it is slower by more
+    than BUILD_REPORT_REGRESSION_THRESHOLD.
+    """
+    limit, all_workspaces, as_json = 20, False, False
+    for arg in args:
+        if arg.startswith("--limit="):
+            limit = int(arg.split("=", 1)[1])
+        elif arg == "--all":
+            all_workspaces = True
+        elif arg == "--json":
+            as_json = True
+        else:
+            logger.error("ERROR: Usage: dazel report [--limit=N] [--all] "
+                         "[--json]")
+            return 1
+
+    entries = []
+    directory = os.path.realpath(di.directory)
+    try:
+        with open(os.path.join(di.cache_directory, BUILD_HISTORY_FILE),
+                  "r") as history_file:
+            for line in history_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if all_workspaces or entry.get("directory") == directory:
+                    entries.append(entry)
+    except (IOError, OSError):
+        pass
+
+    previous = {}
+    for entry in entries:
+        entry["change"], entry["regression"] = None, False
+        if entry.get("exit_code") != 0:
+            continue
+        durations = previous.setdefault(
+            (entry["directory"], tuple(entry["args"])), [])
+        baseline = sorted(durations[-BUILD_REPORT_BASELINE_SIZE:])
+        if baseline:
+            middle = len(baseline) // 2
+            median = (baseline[middle] if len(baseline) % 2 else
+                      (baseline[middle - 1] + baseline[middle]) / 2.0)
+            if median > 0:
+                entry["change"] = (entry["bazel_seconds"] - median) / median
+                entry["regression"] = (entry["change"] >
+                                       BUILD_REPORT_REGRESSION_THRESHOLD)
+        durations.append(entry["bazel_seconds"])
+    if limit > 0:
+        entries = entries[-limit:]
+
+    if as_json:
+        sys.stdout.write("%s\n" % json.dumps(entries, indent=2,
+                                              sort_keys=True))
+        return 0
+    sys.stdout.write("%-19s %4s %8s %8s %8s %6s %8s  %s\n" % (
+        "time", "exit", "bazel", "overhead", "critical", "hits", "change",
+        "command"))
+    for entry in entries:
+        command = " ".join(entry["args"])
+        if all_workspaces:
+            command = "%s: %s" % (entry["directory"], command)
+        sys.stdout.write("%-19s %4s %7.1fs %7.1fs %8s %6s %8s  %s%s\n" % (
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["time"])),
+            "-" if entry["exit_code"] is None else entry["exit_code"],
+            entry["bazel_seconds"], entry["overhead_seconds"],
+            "-" if entry["critical_path_seconds"] is None else
+            "%.1fs" % entry["critical_path_seconds"],
+            "-" if entry["cache_hit_ratio"] is None else
+            "%.0f%%" % (100.0 * entry["cache_hit_ratio"]),
+            "-" if entry["change"] is None else
+            "%+.1f%%" % (100.0 * entry["change"]), command,
+            "  REGRESSION" if entry["regression"] else ""))
+    return 0
+
 
 def main():
+    # Write the trace (if enabled) however we exit.
+    if _tracer is not None:
+        atexit.register(_tracer.write)
+
+    # Show dazel's progress and timings on stderr, if enabled.
+    if os.environ.get("DAZEL_VERBOSE"):
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter("dazel: %(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+    # Run as the background server of the workspace.
+    if sys.argv[1:] == ["--server"]:
+        return run_server()
+
+    # Top up the warm container pool (run in the background after startup).
+    if sys.argv[1:] == ["--fill-pool"]:
+        return DockerInstance.from_config().fill_pool()
+
+    # Reap idle containers (run in the background every DAZEL_GC_INTERVAL).
+    if sys.argv[1:] == ["--gc"]:
+        return run_gc(DockerInstance.from_config(), [])
+
+    # Let the workspace's dazel server run short read-only commands, if
+    # enabled (the others need stdin, a tty and the relaying of signals).
+    if (os.environ.get("DAZEL_SERVER") and
+            DockerInstance._command_verb(sys.argv[1:]) in READ_ONLY_COMMANDS):
+        rc = send_to_server(sys.argv[1:])
+        if rc is not None:
+            return rc
+
     # Read the configuration either from .dazelrc or from the environment.
     di = DockerInstance.from_config()
 
-    # If there is no .dazel_run file, or it is too old, start the DockerInstance.
-    if (not os.path.exists(di.dazel_run_file) or not di.is_running() or
-        (os.path.exists(di.dockerfile) and os.path.getctime(di.dockerfile) >
-         os.path.getctime(di.dazel_run_file))):
-        rc = di.start()
-        if rc:
+    # Manage the cache shared by the containers.
+    if sys.argv[1:2] == ["cache"]:
+        return run_cache_command(di, sys.argv[2:])
+
+    # Run many commands in a single session.
+    if sys.argv[1:2] == ["batch"]:
+        return run_batch(di, sys.argv[2:])
+
+    # Copy the outputs back from the container.
+    if sys.argv[1:2] == ["sync-outputs"]:
+        return di.sync(sys.argv[2:])
+
+    # Pull the images ahead of time.
+    if sys.argv[1:2] == ["prefetch"]:
+        return di.prefetch()
+
+    # Reap idle containers and old output bases.
+    if sys.argv[1:2] == ["gc"]:
+        return run_gc(di, sys.argv[2:])
+
+    # List the reported builds, and the regressions among them.
+    if sys.argv[1:2] == ["report"]:
+        return run_report(di, sys.argv[2:])
+
+    # Split the tests between several containers.
+    if is_sharded_test(sys.argv[1:]):
+        return run_sharded_test(di, sys.argv[2:])
+
+    # If the .dazel_run state matches our configuration, forward the command
+    # line arguments to the container right away, and only probe the container
+    # if the command failed (it may have been stopped or removed since).
+    if di.is_state_fresh(di.load_state()):
+        di.touch_instance_record()
+        rc = di.send_command(sys.argv[1:])
+        if rc == 0 or di.is_running():
             return rc
+        logger.info("Container '%s' is gone, restarting it..." %
+                    di.instance_name)
+
+    # If there is no .dazel_run file, or it is outdated, start the
+    # DockerInstance.
+    rc = di.start()
+    if rc:
+        return rc
 
-    # Forward the command line arguments to the container.
-    return di.send_command(sys.argv[1:])
+    # Forward the command line arguments to the container, and report how long
+    # the first command took (which is where the bazel server starts up).
+    start = time.time()
+    rc = di.send_command(sys.argv[1:])
+    logger.info("First command finished in %.2fs." % (time.time() - start))
+    return rc
 
 
 if __name__ == "__main__":